@@ -0,0 +1,161 @@
+"""HTTP response compression for the ShopLuxe backend.
+
+``CompressionMiddleware`` compresses dynamic responses per request.
+``precompress`` encodes a static body once, so cached payloads can be served
+pre-encoded. Brotli is used when the ``brotli`` package is installed and the
+client accepts it; otherwise gzip.
+"""
+
+import gzip
+import zlib
+from typing import Dict, Iterable, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:  # optional; gzip alone still works
+    brotli = None
+
+# Preferred first when the client weights encodings equally
+SUPPORTED_ENCODINGS = ("br", "gzip") if brotli else ("gzip",)
+
+# Brotli 11 runs at roughly 0.3 MB/s: a few ms for small bodies, but tens of
+# seconds for a large category listing. Bigger bodies use moderate levels,
+# which cost about 1% of that for output only a little larger.
+PRECOMPRESS_MAX_QUALITY_BYTES = 16 * 1024
+
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/javascript", "application/xml", "image/svg+xml")
+
+
+def negotiate(accept_encoding: Optional[str], available: Iterable[str]) -> Optional[str]:
+    """Best encoding from ``available`` for an Accept-Encoding header, or None for identity."""
+    if not accept_encoding:
+        return None
+    weights: Dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        weights[name.strip().lower()] = quality
+    best, best_quality = None, 0.0
+    for encoding in available:
+        quality = weights.get(encoding, weights.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def precompress(body: bytes, minimum_size: int) -> Dict[str, bytes]:
+    """Every supported encoding of a static body, in preference order.
+
+    Bodies up to PRECOMPRESS_MAX_QUALITY_BYTES get maximum compression;
+    larger ones get brotli 5 and gzip 6.
+    """
+    if len(body) < minimum_size:
+        return {}
+    small = len(body) <= PRECOMPRESS_MAX_QUALITY_BYTES
+    encoded = {}
+    if brotli:
+        encoded["br"] = brotli.compress(body, quality=11 if small else 5)
+    encoded["gzip"] = gzip.compress(body, compresslevel=9 if small else 6, mtime=0)
+    return encoded
+
+
+def is_compressible(content_type: str) -> bool:
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+class _StreamCompressor:
+    def __init__(self, encoding: str, gzip_level: int, brotli_quality: int):
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=brotli_quality)
+            self._flush = self._compressor.flush
+            self._finish = self._compressor.finish
+            self.compress = self._compressor.process
+        else:
+            # wbits 31 writes a gzip header and trailer
+            self._compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+            self._flush = lambda: self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            self._finish = self._compressor.flush
+            self.compress = self._compressor.compress
+
+    def chunk(self, body: bytes, final: bool) -> bytes:
+        return self.compress(body) + (self._finish() if final else self._flush())
+
+
+class CompressionMiddleware:
+    """Pure ASGI middleware compressing responses the client accepts.
+
+    Responses that are already encoded, too small, or not a text-like type
+    pass through untouched. Streaming bodies are compressed chunk by chunk
+    and flushed per chunk, so streamed output is not held back. Dynamic
+    responses use moderate levels; see ``precompress`` for cached payloads.
+    """
+
+    def __init__(self, app, minimum_size: int = 500, gzip_level: int = 6, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding"), SUPPORTED_ENCODINGS)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        compressor: Optional[_StreamCompressor] = None
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start_message, compressor, passthrough
+            if message["type"] == "http.response.start":
+                # Hold the headers until the first body chunk decides the encoding
+                start_message = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+            if start_message is not None:
+                headers = MutableHeaders(raw=start_message["headers"])
+                passthrough = (
+                    "content-encoding" in headers
+                    or not is_compressible(headers.get("content-type", ""))
+                    or (not more_body and len(body) < self.minimum_size)
+                )
+                if not passthrough:
+                    compressor = _StreamCompressor(encoding, self.gzip_level, self.brotli_quality)
+                    headers["Content-Encoding"] = encoding
+                    headers.add_vary_header("Accept-Encoding")
+                    if more_body:
+                        del headers["Content-Length"]
+                    else:
+                        body = compressor.chunk(body, final=True)
+                        headers["Content-Length"] = str(len(body))
+                        message = {**message, "body": body}
+                        compressor = None
+                await send(start_message)
+                start_message = None
+                if passthrough or compressor is None:
+                    await send(message)
+                    return
+
+            if passthrough:
+                await send(message)
+                return
+            await send({**message, "body": compressor.chunk(body, final=not more_body)})
+
+        await self.app(scope, receive, send_wrapper)
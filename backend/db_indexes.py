@@ -0,0 +1,212 @@
+"""MongoDB index management for the ShopLuxe backend.
+
+Runs at server startup and as a CLI:
+
+    python db_indexes.py apply      # create missing indexes, report drift
+    python db_indexes.py check      # report drift only, exit 1 if any
+    python db_indexes.py progress   # show index builds currently running
+"""
+
+import asyncio
+import logging
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import typer
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# (collection, keys, options); every index is named so drift can be detected by name
+INDEX_SPECS: List[Tuple[str, List[Tuple[str, int]], Dict[str, Any]]] = [
+    ("users", [("email", ASCENDING)], {"name": "email_unique", "unique": True}),
+    ("affiliates", [("email", ASCENDING)], {"name": "email_unique", "unique": True}),
+    ("affiliates", [("unique_code", ASCENDING)], {"name": "unique_code_unique", "unique": True}),
+    ("sessions", [("expires_at", ASCENDING)], {"name": "expires_at_ttl", "expireAfterSeconds": 0}),
+    ("sessions", [("email", ASCENDING), ("device_fingerprint", ASCENDING), ("ip_address", ASCENDING)],
+     {"name": "email_device_ip"}),
+    ("withdrawals", [("affiliate_code", ASCENDING), ("requested_at", DESCENDING), ("id", DESCENDING)],
+     {"name": "affiliate_code_requested_at"}),
+    ("idempotency_keys", [("expires_at", ASCENDING)], {"name": "expires_at_ttl", "expireAfterSeconds": 0}),
+    ("rate_limits", [("expires_at", ASCENDING)], {"name": "expires_at_ttl", "expireAfterSeconds": 0}),
+    ("orders", [("user_email", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)],
+     {"name": "user_email_created_at"}),
+    ("orders", [("affiliate_code", ASCENDING), ("created_at", DESCENDING)], {"name": "affiliate_code_created_at"}),
+    ("orders", [("created_at", ASCENDING), ("id", ASCENDING)],
+     {"name": "attribution_queue", "partialFilterExpression": {"affiliate_code": {"$type": "string"}}}),
+    ("orders", [("payment_status", ASCENDING), ("created_at", DESCENDING)], {"name": "payment_status_created_at"}),
+    ("categories", [("key", ASCENDING)], {"name": "key_unique", "unique": True}),
+    ("products", [("id", ASCENDING)], {"name": "id_unique", "unique": True}),
+    ("promotions", [("ends_at", ASCENDING)], {"name": "ends_at"}),
+]
+
+# Index options that change index behaviour and must match the spec
+COMPARED_OPTIONS = ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression")
+
+
+def _describe(collection: str, name: str) -> str:
+    return f"{collection}.{name}"
+
+
+def _matches(existing: Dict[str, Any], keys: List[Tuple[str, int]], options: Dict[str, Any]) -> bool:
+    if [tuple(key) for key in existing["key"]] != [tuple(key) for key in keys]:
+        return False
+    return all(existing.get(option) == options.get(option) for option in COMPARED_OPTIONS)
+
+
+async def index_drift(db: AsyncIOMotorDatabase) -> Dict[str, List[str]]:
+    """Compare live indexes with INDEX_SPECS without changing anything."""
+    report: Dict[str, List[str]] = {"missing": [], "conflicting": [], "unmanaged": []}
+    specs_by_collection: Dict[str, Dict[str, Tuple[list, dict]]] = {}
+    for collection, keys, options in INDEX_SPECS:
+        specs_by_collection.setdefault(collection, {})[options["name"]] = (keys, options)
+
+    for collection, specs in specs_by_collection.items():
+        existing = await db[collection].index_information()
+        for name, (keys, options) in specs.items():
+            if name not in existing:
+                report["missing"].append(_describe(collection, name))
+            elif not _matches(existing[name], keys, options):
+                report["conflicting"].append(_describe(collection, name))
+        for name in existing:
+            if name != "_id_" and name not in specs:
+                report["unmanaged"].append(_describe(collection, name))
+    return report
+
+
+async def ensure_indexes(db: AsyncIOMotorDatabase, fix_conflicts: bool = False) -> Dict[str, List[str]]:
+    """Create missing indexes; safe to run repeatedly from every worker.
+
+    Conflicting indexes are left alone unless ``fix_conflicts`` is set, in
+    which case they are dropped and rebuilt from the spec.
+    """
+    drift = await index_drift(db)
+    report = {"created": [], "rebuilt": [], "failed": [], **drift}
+
+    for collection, keys, options in INDEX_SPECS:
+        name = _describe(collection, options["name"])
+        rebuild = fix_conflicts and name in drift["conflicting"]
+        if name not in drift["missing"] and not rebuild:
+            continue
+        try:
+            if rebuild:
+                await db[collection].drop_index(options["name"])
+            await db[collection].create_index(keys, **options)
+            report["rebuilt" if rebuild else "created"].append(name)
+        except OperationFailure as e:
+            # Typically existing duplicates blocking a unique index
+            logger.error(f"Index {name} could not be built: {e}")
+            report["failed"].append(name)
+
+    for key in ("created", "rebuilt"):
+        if report[key]:
+            logger.info(f"Indexes {key}: {', '.join(report[key])}")
+    for key in ("conflicting", "unmanaged"):
+        if report[key]:
+            logger.warning(f"Index drift ({key}): {', '.join(report[key])}")
+    return report
+
+
+async def build_progress(client: AsyncIOMotorClient) -> List[Dict[str, Any]]:
+    """Index builds currently running on the server, with their progress."""
+    pipeline = [
+        {"$currentOp": {"allUsers": True, "idleConnections": False}},
+        {"$match": {"$or": [{"command.createIndexes": {"$exists": True}}, {"msg": {"$regex": "^Index Build"}}]}},
+    ]
+    builds = []
+    async for op in client.admin.aggregate(pipeline):
+        progress = op.get("progress") or {}
+        builds.append({
+            "namespace": op.get("ns"),
+            "indexes": [index.get("name") for index in op.get("command", {}).get("indexes", [])],
+            "message": op.get("msg"),
+            "done": progress.get("done"),
+            "total": progress.get("total"),
+            "seconds_running": op.get("secs_running"),
+        })
+    return builds
+
+
+# CLI
+cli = typer.Typer(help="Manage MongoDB indexes for the ShopLuxe backend.")
+
+
+def _connect() -> Tuple[AsyncIOMotorClient, AsyncIOMotorDatabase]:
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    return client, client[os.environ['DB_NAME']]
+
+
+def _print_report(report: Dict[str, List[str]]):
+    for key, names in report.items():
+        typer.echo(f"{key}: {', '.join(names) if names else '-'}")
+
+
+def _print_builds(builds: List[Dict[str, Any]]):
+    for build in builds:
+        done, total = build["done"], build["total"]
+        percent = f" {100 * done / total:.1f}%" if done is not None and total else ""
+        typer.echo(f"{build['namespace']} {build['indexes']}{percent} {build['message'] or ''}".rstrip())
+
+
+@cli.command()
+def apply(fix_conflicts: bool = typer.Option(False, help="Drop and rebuild indexes whose definition drifted."),
+          poll_interval: float = typer.Option(2.0, help="Seconds between build progress reports.")):
+    """Create missing indexes and report progress while they build."""
+    async def run():
+        client, db = _connect()
+        try:
+            task = asyncio.create_task(ensure_indexes(db, fix_conflicts))
+            while not task.done():
+                await asyncio.wait([task], timeout=poll_interval)
+                if not task.done():
+                    _print_builds(await build_progress(client))
+            return task.result()
+        finally:
+            client.close()
+
+    report = asyncio.run(run())
+    _print_report(report)
+    if report["failed"]:
+        raise typer.Exit(code=1)
+
+
+@cli.command()
+def check():
+    """Report index drift without changing anything; exit 1 on drift."""
+    async def run():
+        client, db = _connect()
+        try:
+            return await index_drift(db)
+        finally:
+            client.close()
+
+    report = asyncio.run(run())
+    _print_report(report)
+    if report["missing"] or report["conflicting"]:
+        raise typer.Exit(code=1)
+
+
+@cli.command()
+def progress():
+    """Show index builds currently running."""
+    async def run():
+        client, _ = _connect()
+        try:
+            return await build_progress(client)
+        finally:
+            client.close()
+
+    builds = asyncio.run(run())
+    if not builds:
+        typer.echo("No index builds in progress")
+    _print_builds(builds)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    cli()
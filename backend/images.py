@@ -0,0 +1,236 @@
+"""Resized product image derivatives for the ShopLuxe backend.
+
+Originals live in a local directory as ``<product_id>.<jpg|jpeg|png|webp>``.
+Derivatives are rendered on a thread pool and kept in a size-bounded LRU
+directory on disk. Their URLs carry a version derived from the original, so
+they can be cached as immutable. Pillow is optional: without it no
+derivative URLs are emitted and the endpoint reports the service unavailable.
+"""
+
+import asyncio
+import hashlib
+import io
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # optional; product images fall back to their remote URLs
+    Image = None
+
+ORIGINAL_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+FORMATS = {"webp": ("WEBP", "image/webp"), "jpeg": ("JPEG", "image/jpeg")}
+# Seconds between full scans of the shared cache directory
+CACHE_RESCAN_INTERVAL = 10.0
+
+
+def snap_width(width: int, widths: Tuple[int, ...]) -> int:
+    """Smallest allowed width at least ``width``, so arbitrary requests share derivatives."""
+    for allowed in widths:
+        if allowed >= width:
+            return allowed
+    return widths[-1]
+
+
+def render_derivative(original: Path, width: int, fmt: str, quality: int) -> bytes:
+    """Resize to ``width`` (never upscaling) and encode; runs on a worker thread."""
+    pil_format, _ = FORMATS[fmt]
+    with Image.open(original) as image:
+        # Lets the JPEG decoder downscale while decoding; both sides stay >= width
+        # so the result is still large enough after an EXIF rotation
+        image.draft("RGB", (width, width))
+        image = ImageOps.exif_transpose(image)
+        if image.width > width:
+            image = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+        if pil_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        options = {"optimize": True} if pil_format == "JPEG" else {"method": 4}
+        buffer = io.BytesIO()
+        image.save(buffer, pil_format, quality=quality, **options)
+        return buffer.getvalue()
+
+
+class DerivativeCache:
+    """Directory of rendered derivatives, evicted least recently used past a byte budget.
+
+    Recency is the file mtime: hits touch the file, so the order survives
+    restarts and is shared by every worker using the directory. Each worker
+    tracks its own writes between rescans, and rescans the whole directory
+    at most every ``rescan_interval`` seconds to count the other workers'
+    files. So the budget holds for the directory as a whole, overshooting
+    by at most what the other workers rendered since the last rescan. A
+    file another worker evicted is simply rendered again.
+
+    Every method does disk I/O and is meant for one dedicated thread, which
+    also keeps the bookkeeping free of races; the first lookup scans.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int, rescan_interval: float = CACHE_RESCAN_INTERVAL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.rescan_interval = rescan_interval
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self.size = 0
+        self._scanned: Optional[float] = None
+
+    def _rescan(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        self._entries = OrderedDict((name, size) for _, name, size in sorted(files))
+        self.size = sum(self._entries.values())
+        self._scanned = time.monotonic()
+        self._evict()
+
+    def get(self, name: str) -> Optional[Path]:
+        if self._scanned is None:
+            self._rescan()
+        path = self.directory / name
+        if name not in self._entries:
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self.size -= self._entries.pop(name)
+            return None
+        self._entries.move_to_end(name)
+        return path
+
+    def put(self, name: str, data: bytes) -> Path:
+        path = self.directory / name
+        tmp = path.with_name(f"{name}.{os.getpid()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        if self._scanned is None or time.monotonic() - self._scanned >= self.rescan_interval:
+            self._rescan()
+            return path
+        if name in self._entries:
+            self.size -= self._entries.pop(name)
+        self._entries[name] = len(data)
+        self.size += len(data)
+        self._evict()
+        return path
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _evict(self):
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self.size -= size
+            try:
+                (self.directory / name).unlink()
+            except FileNotFoundError:
+                pass
+
+
+class ImageDerivatives:
+    """Finds originals and produces cached derivatives, one render per key at a time."""
+
+    def __init__(self, originals_dir: Path, cache_dir: Path, max_cache_bytes: int, workers: int,
+                 widths: Tuple[int, ...], quality: int):
+        self.originals_dir = originals_dir
+        self.cache_dir = cache_dir
+        self.max_cache_bytes = max_cache_bytes
+        self.workers = workers
+        self.widths = widths
+        self.quality = quality
+        self.rendered = 0
+        self._cache: Optional[DerivativeCache] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._cache_io: Optional[ThreadPoolExecutor] = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    @property
+    def available(self) -> bool:
+        return Image is not None
+
+    def scan_originals(self) -> Dict[str, Tuple[Path, str]]:
+        """product_id -> (original path, version) for every original on disk."""
+        originals: Dict[str, Tuple[Path, str]] = {}
+        if not self.available or not self.originals_dir.is_dir():
+            return originals
+        for entry in os.scandir(self.originals_dir):
+            stem, ext = os.path.splitext(entry.name)
+            if ext.lower() in ORIGINAL_EXTENSIONS and entry.is_file():
+                stat = entry.stat()
+                version = hashlib.sha256(f"{entry.name}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()[:12]
+                originals[stem] = (Path(entry.path), version)
+        return originals
+
+    def url(self, product_id: str, version: str, width: int, fmt: str = "webp") -> str:
+        return f"/api/img/{product_id}?w={width}&fmt={fmt}&v={version}"
+
+    def srcset(self, product_id: str, version: str, fmt: str = "webp") -> str:
+        return ", ".join(f"{self.url(product_id, version, width, fmt)} {width}w" for width in self.widths)
+
+    async def derivative(self, product_id: str, original: Path, version: str, width: int, fmt: str) -> bytes:
+        """The derivative's bytes, read from the cache or rendered into it."""
+        if self._cache is None:
+            self._cache = DerivativeCache(self.cache_dir, self.max_cache_bytes)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="image-render")
+        if self._cache_io is None:
+            self._cache_io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="image-cache")
+        name = f"{product_id}-{version}-{width}.{fmt}"
+        loop = asyncio.get_running_loop()
+        for attempt in range(3):
+            path = await self._derive(name, original, width, fmt)
+            try:
+                return await loop.run_in_executor(self._cache_io, path.read_bytes)
+            except FileNotFoundError:
+                # Another worker evicted it since it was found or written; the
+                # next lookup notices it is gone and renders it again
+                if attempt == 2:
+                    raise
+
+    async def _derive(self, name: str, original: Path, width: int, fmt: str) -> Path:
+        loop = asyncio.get_running_loop()
+        path = await loop.run_in_executor(self._cache_io, self._cache.get, name)
+        if path:
+            return path
+        inflight = self._inflight.get(name)
+        if inflight:
+            return await asyncio.shield(inflight)
+
+        future = loop.create_future()
+        self._inflight[name] = future
+        try:
+            data = await loop.run_in_executor(
+                self._executor, render_derivative, original, width, fmt, self.quality
+            )
+            path = await loop.run_in_executor(self._cache_io, self._cache.put, name, data)
+            self.rendered += 1
+            future.set_result(path)
+            return path
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # waiters re-raise it; don't log it as unretrieved
+            raise
+        finally:
+            del self._inflight[name]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "rendered": self.rendered,
+            "cache_bytes": self._cache.size if self._cache else 0,
+            "cache_entries": len(self._cache) if self._cache else 0,
+        }
+
+    def shutdown(self):
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._cache_io:
+            self._cache_io.shutdown(wait=True)
+            self._cache_io = None
@@ -0,0 +1,85 @@
+"""Operational commands for the ShopLuxe backend.
+
+    python manage.py rebuild-attribution    # recompute affiliate counters from all orders
+    python manage.py migrate-withdrawals    # move embedded withdrawal_history into withdrawals
+    python manage.py promote --category clothes --extra-discount 10 --ends-at 2025-01-31T23:59:59
+                                            # 10% off a category until a UTC time
+"""
+
+import asyncio
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+import typer
+
+import server
+
+cli = typer.Typer(help="Operational commands for the ShopLuxe backend.")
+
+
+@cli.callback()
+def main():
+    """Operational commands for the ShopLuxe backend."""
+
+
+def _run(command):
+    """Run ``command`` with the server's Mongo client connected, closing it afterwards."""
+    async def run():
+        server.connect_mongo()
+        try:
+            return await command()
+        finally:
+            server.client.close()
+
+    return asyncio.run(run())
+
+
+@cli.command("rebuild-attribution")
+def rebuild_attribution(take_over: bool = typer.Option(
+        False, help="Take the attribution lease from a running worker instead of failing.")):
+    """Recompute every affiliate's sales and commission counters from the full order history."""
+    try:
+        affiliates = _run(lambda: server.attribution.rebuild(take_over))
+    except RuntimeError as e:
+        typer.echo(f"{e}; rerun with --take-over to rebuild while workers are running", err=True)
+        raise typer.Exit(code=1)
+    typer.echo(f"Rebuilt attribution for {affiliates} affiliates")
+
+
+@cli.command("migrate-withdrawals")
+def migrate_withdrawals():
+    """Move embedded withdrawal_history arrays into the withdrawals collection, as startup does."""
+    _run(server.migrate_withdrawal_history)
+    typer.echo("Withdrawal history migrated")
+
+
+@cli.command()
+def promote(extra_discount: int = typer.Option(..., min=1, max=100, help="Percent added to each product's discount."),
+            category: Optional[str] = typer.Option(None, help="Limit the promotion to one category."),
+            product_id: Optional[List[str]] = typer.Option(None, help="Limit the promotion to these products; repeatable."),
+            starts_at: Optional[datetime] = typer.Option(None, help="UTC start; defaults to now."),
+            ends_at: Optional[datetime] = typer.Option(None, help="UTC end; omit for an open-ended promotion."),
+            ends_in: Optional[float] = typer.Option(None, min=0, help="Seconds from now until the promotion ends.")):
+    """Discount a category, a set of products, or the whole catalog until a given time."""
+    if ends_at and ends_in is not None:
+        raise typer.BadParameter("Pass either --ends-at or --ends-in, not both", param_hint="--ends-in")
+    if ends_in is not None:
+        ends_at = datetime.utcnow() + timedelta(seconds=ends_in)
+    if ends_at and ends_at <= (starts_at or datetime.utcnow()):
+        raise typer.BadParameter("The promotion must end after it starts", param_hint="--ends-at")
+
+    async def command():
+        if category and not await server.db.categories.find_one({"key": category}, {"_id": 1}):
+            raise typer.BadParameter(f"Unknown category {category!r}", param_hint="--category")
+        return await server.create_promotion(extra_discount, category, product_id or None, ends_at, starts_at)
+
+    promotion = _run(command)
+    scope = category or (", ".join(promotion.product_ids) if promotion.product_ids else "the whole catalog")
+    until = promotion.ends_at.isoformat() if promotion.ends_at else "further notice"
+    typer.echo(f"Promotion {promotion.id}: {extra_discount}% off {scope} "
+               f"from {promotion.starts_at.isoformat()} until {until}")
+
+
+if __name__ == "__main__":
+    server.configure_logging()
+    cli()
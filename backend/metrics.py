@@ -0,0 +1,281 @@
+"""In-process metrics for the ShopLuxe backend, rendered as Prometheus text.
+
+Request metrics are recorded by ``MetricsMiddleware`` on the event loop.
+Mongo command and connection-pool metrics come from pymongo monitoring
+listeners. Those run on Motor's executor threads, so they update under a
+lock. Recording is a dict lookup plus a bisect, cheap enough to leave on.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import monitoring
+
+# Seconds; shared by request and Mongo command latency histograms
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# (name, help, type, [(labels, value)]) tuples produced by registered collectors
+Sample = Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]
+
+
+class Histogram:
+    __slots__ = ("counts", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.sum += seconds
+
+    def copy(self) -> "Histogram":
+        histogram = Histogram()
+        histogram.counts, histogram.sum = list(self.counts), self.sum
+        return histogram
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(str(value))}"' for key, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class MetricsRegistry:
+    """Counters and histograms keyed by label tuples, plus pluggable gauge collectors."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests: Dict[Tuple[str, str, str], int] = {}
+        self.request_latency: Dict[Tuple[str, str], Histogram] = {}
+        self.requests_in_flight = 0
+        self.commands: Dict[Tuple[str, str], Histogram] = {}
+        self.command_failures: Dict[Tuple[str, str], int] = {}
+        self.pool: Dict[str, Dict[str, float]] = {}
+        self.checkout_latency: Dict[str, Histogram] = {}
+        self._collectors: List[Callable[[], Iterable[Sample]]] = []
+
+    def add_collector(self, collector: Callable[[], Iterable[Sample]]):
+        """Register a callable producing gauge or counter samples at scrape time."""
+        self._collectors.append(collector)
+
+    # Requests (event loop thread only)
+    def observe_request(self, method: str, route: str, status: int, seconds: float):
+        key = (method, route, str(status))
+        self.requests[key] = self.requests.get(key, 0) + 1
+        histogram = self.request_latency.get((method, route))
+        if histogram is None:
+            histogram = self.request_latency[(method, route)] = Histogram()
+        histogram.observe(seconds)
+
+    # Mongo (listener threads)
+    def observe_command(self, collection: str, command: str, seconds: float, failed: bool):
+        key = (collection, command)
+        with self._lock:
+            histogram = self.commands.get(key)
+            if histogram is None:
+                histogram = self.commands[key] = Histogram()
+            histogram.observe(seconds)
+            if failed:
+                self.command_failures[key] = self.command_failures.get(key, 0) + 1
+
+    def pool_event(self, address: str, field: str, delta: float = 1, checkout_seconds: Optional[float] = None):
+        with self._lock:
+            stats = self.pool.setdefault(address, {
+                "connections": 0, "checked_out": 0, "created": 0, "closed": 0, "checkout_failures": 0
+            })
+            stats[field] += delta
+            if checkout_seconds is not None:
+                histogram = self.checkout_latency.get(address)
+                if histogram is None:
+                    histogram = self.checkout_latency[address] = Histogram()
+                histogram.observe(checkout_seconds)
+
+    def render(self) -> str:
+        lines: List[str] = []
+
+        def family(name: str, help_text: str, kind: str):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def histogram_lines(name: str, labels: Dict[str, str], histogram: Histogram):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels({**labels, 'le': repr(bound)})} {cumulative}")
+            cumulative += histogram.counts[-1]
+            lines.append(f"{name}_bucket{_labels({**labels, 'le': '+Inf'})} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {_format_value(histogram.sum)}")
+            lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+
+        family("http_requests_total", "HTTP requests by method, route and status.", "counter")
+        for (method, route, status), count in sorted(self.requests.items()):
+            lines.append(f"http_requests_total{_labels({'method': method, 'route': route, 'status': status})} {count}")
+        family("http_request_duration_seconds", "HTTP request latency by method and route.", "histogram")
+        for (method, route), histogram in sorted(self.request_latency.items()):
+            histogram_lines("http_request_duration_seconds", {"method": method, "route": route}, histogram)
+        family("http_requests_in_flight", "HTTP requests currently being served.", "gauge")
+        lines.append(f"http_requests_in_flight {self.requests_in_flight}")
+
+        # Snapshot listener-owned state so rendering never holds the lock
+        with self._lock:
+            commands = {key: histogram.copy() for key, histogram in self.commands.items()}
+            failures = dict(self.command_failures)
+            pool = {address: dict(stats) for address, stats in self.pool.items()}
+            checkouts = {address: histogram.copy() for address, histogram in self.checkout_latency.items()}
+
+        family("mongodb_command_duration_seconds", "MongoDB command latency by collection and command.", "histogram")
+        for (collection, command), histogram in sorted(commands.items()):
+            histogram_lines("mongodb_command_duration_seconds", {"collection": collection, "command": command}, histogram)
+        family("mongodb_command_failures_total", "Failed MongoDB commands by collection and command.", "counter")
+        for (collection, command), count in sorted(failures.items()):
+            lines.append(f"mongodb_command_failures_total{_labels({'collection': collection, 'command': command})} {count}")
+
+        for field, kind, help_text in (
+            ("connections", "gauge", "Open connections in the MongoDB pool."),
+            ("checked_out", "gauge", "MongoDB connections currently checked out."),
+            ("created", "counter", "MongoDB connections created."),
+            ("closed", "counter", "MongoDB connections closed."),
+            ("checkout_failures", "counter", "MongoDB connection checkouts that failed or timed out."),
+        ):
+            name = f"mongodb_pool_{field}" + ("_total" if kind == "counter" else "")
+            family(name, help_text, kind)
+            for address, stats in sorted(pool.items()):
+                lines.append(f"{name}{_labels({'address': address})} {_format_value(stats[field])}")
+        family("mongodb_pool_checkout_duration_seconds", "Time spent waiting for a MongoDB connection.", "histogram")
+        for address, histogram in sorted(checkouts.items()):
+            histogram_lines("mongodb_pool_checkout_duration_seconds", {"address": address}, histogram)
+
+        for collector in self._collectors:
+            for name, help_text, kind, samples in collector():
+                family(name, help_text, kind)
+                for labels, value in samples:
+                    lines.append(f"{name}{_labels(labels)} {_format_value(value)}")
+
+        return "\n".join(lines) + "\n"
+
+
+class CommandTimer(monitoring.CommandListener):
+    """Times every MongoDB command by collection and command name."""
+
+    def __init__(self, registry: MetricsRegistry, max_pending: int = 10000):
+        self.registry = registry
+        self.max_pending = max_pending
+        self._pending: Dict[Tuple[Any, int], str] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        target = event.command.get(event.command_name)
+        collection = target if isinstance(target, str) else "-"
+        if len(self._pending) < self.max_pending:
+            self._pending[(event.connection_id, event.request_id)] = collection
+
+    def _finish(self, event, failed: bool):
+        collection = self._pending.pop((event.connection_id, event.request_id), "-")
+        self.registry.observe_command(collection, event.command_name, event.duration_micros / 1e6, failed)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        self._finish(event, failed=False)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        self._finish(event, failed=True)
+
+
+class PoolTracker(monitoring.ConnectionPoolListener):
+    """Tracks MongoDB pool size, checkouts and checkout wait per server."""
+
+    def __init__(self, registry: MetricsRegistry):
+        self.registry = registry
+        self._checkout_started: Dict[int, float] = {}
+
+    @staticmethod
+    def _address(event) -> str:
+        host, port = event.address
+        return f"{host}:{port}"
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        address = self._address(event)
+        self.registry.pool_event(address, "created")
+        self.registry.pool_event(address, "connections")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        address = self._address(event)
+        self.registry.pool_event(address, "closed")
+        self.registry.pool_event(address, "connections", -1)
+
+    def connection_check_out_started(self, event):
+        self._checkout_started[threading.get_ident()] = time.perf_counter()
+
+    def _checkout_seconds(self) -> Optional[float]:
+        started = self._checkout_started.pop(threading.get_ident(), None)
+        return None if started is None else time.perf_counter() - started
+
+    def connection_check_out_failed(self, event):
+        self.registry.pool_event(self._address(event), "checkout_failures", checkout_seconds=self._checkout_seconds())
+
+    def connection_checked_out(self, event):
+        self.registry.pool_event(self._address(event), "checked_out", checkout_seconds=self._checkout_seconds())
+
+    def connection_checked_in(self, event):
+        self.registry.pool_event(self._address(event), "checked_out", -1)
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware recording per-route counts, statuses and latency.
+
+    Routes are labelled by their path template, so /api/product/{product_id}
+    is one series however many products are requested; unmatched paths
+    share a single "unmatched" label to keep cardinality bounded.
+    """
+
+    def __init__(self, app, registry: MetricsRegistry):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        self.registry.requests_in_flight += 1
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.registry.requests_in_flight -= 1
+            route = scope.get("route")
+            self.registry.observe_request(
+                scope["method"], getattr(route, "path", "unmatched"), status, time.perf_counter() - started
+            )
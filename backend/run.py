@@ -0,0 +1,155 @@
+"""Production entry point: forked uvicorn workers sharing a preloaded catalog.
+
+    python run.py                       # one worker per core on 0.0.0.0:8001
+    python run.py --workers 4 --port 8001
+
+The parent imports the app, builds the catalog indexes from Mongo, freezes
+the GC so those objects stay untouched, binds the socket and forks. Workers
+inherit the catalog copy-on-write and open their own Mongo clients and
+background loops in the app's lifespan. SIGTERM or SIGINT drains every worker
+gracefully; workers that die unexpectedly are replaced.
+"""
+
+import argparse
+import asyncio
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+import uvicorn
+
+import server
+
+logger = logging.getLogger("shopluxe.run")
+
+# Workers that crash faster than this after starting are restarted with a delay
+RESTART_BACKOFF_SECONDS = 1.0
+
+
+def bind_socket(host: str, port: int, backlog: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(sock: socket.socket, args: argparse.Namespace):
+    # Own process group, so a terminal Ctrl-C reaches only the supervisor, which
+    # then sends one SIGTERM; a second signal would make uvicorn skip the drain
+    os.setpgid(0, 0)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    config = uvicorn.Config(
+        server.app,
+        lifespan="on",
+        log_level=args.log_level,
+        proxy_headers=True,
+        forwarded_allow_ips=args.forwarded_allow_ips,
+        timeout_keep_alive=args.keep_alive,
+        timeout_graceful_shutdown=args.graceful_timeout,
+    )
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+class Supervisor:
+    """Forks workers, replaces ones that die, and drains them all on shutdown."""
+
+    def __init__(self, sock: socket.socket, args: argparse.Namespace):
+        self.sock = sock
+        self.args = args
+        self.workers = {}  # pid -> start time
+        self.stopping = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(self.sock, self.args)
+            except BaseException:
+                logger.exception("Worker crashed")
+                code = 1
+            finally:
+                os._exit(code)
+        self.workers[pid] = time.monotonic()
+        logger.info(f"Started worker {pid}")
+
+    def stop(self, signum, frame):
+        if self.stopping:
+            return
+        self.stopping = True
+        logger.info(f"Received {signal.Signals(signum).name}, draining {len(self.workers)} workers")
+        for pid in self.workers:
+            os.kill(pid, signal.SIGTERM)
+
+    def run(self) -> int:
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for _ in range(self.args.workers):
+            self.spawn()
+
+        deadline = None
+        while self.workers:
+            if self.stopping and deadline is None:
+                # Allow the graceful timeout plus time for lifespan shutdown to flush
+                deadline = time.monotonic() + self.args.graceful_timeout + 10
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                if deadline and time.monotonic() > deadline:
+                    for stuck in self.workers:
+                        logger.warning(f"Worker {stuck} did not drain in time, killing it")
+                        os.kill(stuck, signal.SIGKILL)
+                    deadline = float("inf")
+                time.sleep(0.2)
+                continue
+            started = self.workers.pop(pid)
+            if self.stopping:
+                logger.info(f"Worker {pid} exited")
+                continue
+            logger.error(f"Worker {pid} died with status {os.waitstatus_to_exitcode(status)}, restarting")
+            if time.monotonic() - started < RESTART_BACKOFF_SECONDS:
+                time.sleep(RESTART_BACKOFF_SECONDS)
+            self.spawn()
+        self.sock.close()
+        return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Run the ShopLuxe API with preloaded, forked workers.")
+    parser.add_argument("--host", default=os.environ.get("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", "8001")))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", str(os.cpu_count() or 1))))
+    parser.add_argument("--backlog", type=int, default=2048)
+    parser.add_argument("--keep-alive", type=int, default=5, help="Keep-alive timeout in seconds")
+    parser.add_argument("--graceful-timeout", type=int, default=30, help="Seconds to drain in-flight requests")
+    parser.add_argument("--forwarded-allow-ips", default=os.environ.get("FORWARDED_ALLOW_IPS", "127.0.0.1"))
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    server.configure_logging()
+    try:
+        asyncio.run(server.preload())
+        logger.info(f"Preloaded catalog version {server.catalog_store.version} "
+                    f"with {len(server.catalog_store.current.by_id)} products")
+    except Exception as e:
+        # Workers load the catalog themselves once Mongo is reachable
+        logger.error(f"Preload failed, workers will load the catalog: {e}")
+    # Keep the preloaded objects out of future collections so GC passes never write to shared pages
+    gc.freeze()
+
+    sock = bind_socket(args.host, args.port, args.backlog)
+    logger.info(f"Listening on {args.host}:{args.port} with {args.workers} workers")
+    return Supervisor(sock, args).run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
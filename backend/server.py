@@ -1,13 +1,27 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Request, BackgroundTasks, Depends
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Request, BackgroundTasks, Depends, Query, Header
+from fastapi.responses import JSONResponse, RedirectResponse, Response
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+import numpy as np
+import orjson
+from pymongo import ReadPreference, ReturnDocument, UpdateOne, WriteConcern
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from db_indexes import ensure_indexes
+from metrics import CommandTimer, MetricsMiddleware, MetricsRegistry, PoolTracker
+from compression import CompressionMiddleware, negotiate, precompress
+from images import FORMATS as IMAGE_FORMATS, ImageDerivatives, snap_width
 import os
+import asyncio
+import base64
+import bisect
 import logging
+from contextlib import asynccontextmanager
 from pathlib import Path
+from urllib.parse import quote
 from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Literal
 import uuid
 from datetime import datetime, timedelta
 import smtplib
@@ -15,19 +29,145 @@ from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import random
 import hashlib
+import heapq
+import hmac
+import itertools
 import json
+import re
 import secrets
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from passlib.context import CryptContext
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+logger = logging.getLogger(__name__)
+
+# Request, Mongo command and connection pool metrics, served at /api/metrics
+metrics = MetricsRegistry()
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', '100'))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', '10'))
+MONGO_MAX_IDLE_TIME_MS = int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', '300000'))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000'))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', '2000'))
+# Per-collection overrides, e.g. "products:secondaryPreferred,categories:secondaryPreferred"
+MONGO_READ_PREFERENCES = os.environ.get('MONGO_READ_PREFERENCES', '')
+# e.g. "orders:majority,affiliates:1"
+MONGO_WRITE_CONCERNS = os.environ.get('MONGO_WRITE_CONCERNS', '')
+READINESS_MAX_POOL_SATURATION = float(os.environ.get('READINESS_MAX_POOL_SATURATION', '0.9'))
 
-# Create the main app without a prefix
-app = FastAPI(title="ShopLuxe - Luxury E-commerce API")
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+def parse_collection_settings(value: str) -> Dict[str, str]:
+    """'products:secondaryPreferred,orders:primary' -> {'products': 'secondaryPreferred', ...}"""
+    settings = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        collection, setting = item.split(':', 1)
+        settings[collection.strip()] = setting.strip()
+    return settings
+
+def collection_options() -> Dict[str, Dict[str, Any]]:
+    options: Dict[str, Dict[str, Any]] = {}
+    for collection, mode in parse_collection_settings(MONGO_READ_PREFERENCES).items():
+        options.setdefault(collection, {})["read_preference"] = READ_PREFERENCES[mode]
+    for collection, w in parse_collection_settings(MONGO_WRITE_CONCERNS).items():
+        options.setdefault(collection, {})["write_concern"] = WriteConcern(w=int(w) if w.isdigit() else w)
+    return options
+
+class ConfiguredDatabase:
+    """Motor database whose collections carry their configured read preference and write concern.
+
+    ``db.orders`` and ``db["orders"]`` resolve through the overrides;
+    database methods such as ``command`` and ``watch`` pass straight through.
+    """
+
+    def __init__(self, database, options: Dict[str, Dict[str, Any]]):
+        self._database = database
+        self._options = options
+        self._collections: Dict[str, Any] = {}
+
+    def __getitem__(self, name: str):
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._database.get_collection(name, **self._options.get(name, {}))
+            self._collections[name] = collection
+        return collection
+
+    def __getattr__(self, name: str):
+        if name.startswith('_') or hasattr(type(self._database), name):
+            return getattr(self._database, name)
+        return self[name]
+
+def build_mongo_client() -> AsyncIOMotorClient:
+    return AsyncIOMotorClient(
+        mongo_url,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+        serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        event_listeners=[CommandTimer(metrics), PoolTracker(metrics)]
+    )
+
+# Created at startup so each worker builds its own client on its own event loop
+client: Optional[AsyncIOMotorClient] = None
+db: Optional[ConfiguredDatabase] = None
+mongo_warm = False
+
+def connect_mongo():
+    global client, db
+    client = build_mongo_client()
+    db = ConfiguredDatabase(client[os.environ['DB_NAME']], collection_options())
+
+async def warm_mongo_pool():
+    """Ping, then hold MONGO_MIN_POOL_SIZE concurrent pings so that many connections are open."""
+    global mongo_warm
+    started = time.perf_counter()
+    await db.command("ping")
+    await asyncio.gather(*(db.command("ping") for _ in range(MONGO_MIN_POOL_SIZE)))
+    mongo_warm = True
+    logger.info(f"MongoDB pool warmed with {MONGO_MIN_POOL_SIZE} connections in "
+                f"{time.perf_counter() - started:.3f}s")
+
+def pool_saturation() -> float:
+    """Highest share of the connection pool checked out on any server."""
+    checked_out = [stats["checked_out"] for stats in metrics.pool.values()]
+    return max(checked_out, default=0) / MONGO_MAX_POOL_SIZE
+
+# Fast JSON rendering
+def encode_default(value: Any) -> Any:
+    """orjson fallback for pydantic models; datetimes, dicts and lists are native.
+
+    Models here have no aliases or custom serializers, so their field dict
+    is exactly what model_dump() would produce, without the copy.
+    """
+    if isinstance(value, BaseModel):
+        return value.__dict__
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+def dump_json(content: Any) -> bytes:
+    return orjson.dumps(content, default=encode_default, option=orjson.OPT_NON_STR_KEYS)
+
+class FastJSONResponse(JSONResponse):
+    """JSON response rendered by orjson.
+
+    Returning one directly from an endpoint also skips FastAPI's
+    jsonable_encoder pass, which dominates the cost of large responses.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return dump_json(content)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -56,7 +196,7 @@ PRODUCT_CATEGORIES = {
     }
 }
 
-# Sample Products
+# Sample Products, seeded into the products collection on first start
 PRODUCTS = {
     "aesthetic": [
         {"id": "aes_001", "name": "Diamond Eternity Ring", "original_price": 185.50, "discount": 25, "image": "https://images.unsplash.com/photo-1617038220319-276d3cfab638?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NDQ2NDF8MHwxfHNlYXJjaHwxfHxqZXdlbHJ5fGVufDB8fHx8MTc1NDM5NTQ4NXww&ixlib=rb-4.1.0&q=85"},
@@ -103,13 +243,17 @@ class User(BaseModel):
     password_hash: str
     ip_address: str
     device_fingerprint: str
-    session_token: Optional[str] = None
-    session_expires: Optional[datetime] = None
     email_verified: bool = False
     verification_code: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
     is_affiliate: bool = False
 
+class Session(BaseModel):
+    token: str
+    user_id: str
+    email: str
+    expires_at: datetime
+
 class UserCreate(BaseModel):
     email: EmailStr
     password: str
@@ -134,6 +278,23 @@ class Product(BaseModel):
     category: str
     is_account: bool = False
     verified: bool = False
+    # Local resized derivatives of ``image``, when an original is on disk
+    thumbnail: Optional[str] = None
+    image_srcset: Optional[str] = None
+
+class Promotion(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    extra_discount: int = Field(..., ge=1, le=100)
+    category: Optional[str] = None
+    product_ids: Optional[List[str]] = None
+    starts_at: datetime = Field(default_factory=datetime.utcnow)
+    ends_at: Optional[datetime] = None
+
+    def is_active(self, now: datetime) -> bool:
+        return self.starts_at <= now and (self.ends_at is None or now < self.ends_at)
+
+class ProductBatchRequest(BaseModel):
+    ids: List[str] = Field(..., min_length=1, max_length=100)
 
 class Order(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -169,16 +330,113 @@ class Affiliate(BaseModel):
     total_clicks: int = 0
     total_sales: int = 0
     commission_balance: float = 0.0
+    commission_earned: float = 0.0
+    commission_withdrawn: float = 0.0
     created_at: datetime = Field(default_factory=datetime.utcnow)
-    withdrawal_history: List[Dict] = []
+
+class Withdrawal(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    affiliate_code: str
+    amount: float
+    paypal_email: str
+    status: str = "pending"
+    requested_at: datetime = Field(default_factory=datetime.utcnow)
+
+class WithdrawalRequest(BaseModel):
+    amount: float = Field(..., gt=0)
 
 class AffiliateSignup(BaseModel):
     email: EmailStr
     paypal_email: EmailStr
 
 # Helper functions
-def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode()).hexdigest()
+# Password hashing
+PASSWORD_HASH_SCHEME = os.environ.get('PASSWORD_HASH_SCHEME', 'pbkdf2_sha256')
+PASSWORD_HASH_ROUNDS = os.environ.get('PASSWORD_HASH_ROUNDS')
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', str(os.cpu_count() or 2)))
+
+def build_password_context() -> CryptContext:
+    """Configured scheme first; every other scheme (including the legacy
+    unsalted hex SHA-256) still verifies but is marked for upgrade."""
+    schemes = [PASSWORD_HASH_SCHEME] + [
+        scheme for scheme in ("argon2", "bcrypt", "pbkdf2_sha256", "hex_sha256")
+        if scheme != PASSWORD_HASH_SCHEME
+    ]
+    settings = {}
+    if PASSWORD_HASH_ROUNDS:
+        # Hashes below the configured cost are upgraded on the next login
+        settings[f"{PASSWORD_HASH_SCHEME}__default_rounds"] = int(PASSWORD_HASH_ROUNDS)
+        settings[f"{PASSWORD_HASH_SCHEME}__min_rounds"] = int(PASSWORD_HASH_ROUNDS)
+    return CryptContext(schemes=schemes, deprecated="auto", **settings)
+
+class PasswordHasher:
+    """Runs slow KDF work on a bounded thread pool so the event loop never blocks.
+
+    The KDF backends release the GIL, so threads give real parallelism.
+    ``queue_depth`` counts calls waiting for a free worker; sustained
+    non-zero values mean login bursts are saturating the CPU. The pool is
+    created on first use in each worker and torn down by its lifespan.
+    """
+
+    def __init__(self, context: CryptContext, workers: int):
+        self.context = context
+        self.workers = workers
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.in_flight = 0
+        self.peak_queue_depth = 0
+        self.completed = 0
+        self.busy_seconds = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return max(0, self.in_flight - self.workers)
+
+    @staticmethod
+    def _timed(fn, *args) -> tuple:
+        started = time.perf_counter()
+        result = fn(*args)
+        return result, time.perf_counter() - started
+
+    async def _run(self, fn, *args):
+        # Counters are only touched on the event loop thread
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password-hash")
+        self.in_flight += 1
+        self.peak_queue_depth = max(self.peak_queue_depth, self.queue_depth)
+        try:
+            result, elapsed = await asyncio.get_running_loop().run_in_executor(self.executor, self._timed, fn, *args)
+            self.busy_seconds += elapsed
+            return result
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+
+    async def hash(self, password: str) -> str:
+        return await self._run(self.context.hash, password)
+
+    async def verify_and_update(self, password: str, password_hash: str) -> tuple:
+        """Return (valid, new_hash); new_hash is set when the stored hash should be upgraded."""
+        return await self._run(self.context.verify_and_update, password, password_hash)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "peak_queue_depth": self.peak_queue_depth,
+            "completed": self.completed,
+            "busy_seconds": round(self.busy_seconds, 3)
+        }
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+password_hasher = PasswordHasher(build_password_context(), PASSWORD_HASH_WORKERS)
+
+async def hash_password(password: str) -> str:
+    return await password_hasher.hash(password)
 
 def generate_verification_code() -> str:
     return str(random.randint(10000, 99999))
@@ -186,9 +444,1524 @@ def generate_verification_code() -> str:
 def generate_session_token() -> str:
     return secrets.token_urlsafe(32)
 
+class TTLCache:
+    """Small in-process LRU whose entries also expire after a TTL."""
+
+    MISSING = object()
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[Any, tuple]" = OrderedDict()
+
+    def get(self, key: Any) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return self.MISSING
+        value, expires = entry
+        if expires <= time.monotonic():
+            del self._entries[key]
+            return self.MISSING
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Any, value: Any, ttl: Optional[float] = None):
+        self._entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: Any):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+def encode_time_cursor(moment: datetime, item_id: str) -> str:
+    raw = json.dumps([moment.isoformat(), item_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_time_cursor(cursor: str) -> tuple:
+    """Decode a (datetime, id) keyset cursor, rejecting anything malformed with a 400."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        moment, item_id = json.loads(raw)
+        return datetime.fromisoformat(moment), str(item_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
 def calculate_final_price(original_price: float, discount: int) -> float:
     return round(original_price * (1 - discount / 100), 2)
 
+# Pre-serialized responses
+CATALOG_CACHE_CONTROL = "public, max-age=60, must-revalidate"
+COMPRESSION_MINIMUM_SIZE = int(os.environ.get('COMPRESSION_MINIMUM_SIZE', '500'))
+
+class CachedPayload:
+    """JSON body encoded and compressed once, with a strong ETag derived from its bytes.
+
+    Each content coding is its own representation, so compressed variants
+    get their own ETag, suffixed with the coding.
+    """
+
+    def __init__(self, data: Any):
+        self.body = dump_json(data)
+        self.etag = f'"{hashlib.sha256(self.body).hexdigest()[:32]}"'
+        self.encoded = precompress(self.body, COMPRESSION_MINIMUM_SIZE)
+
+    def variant_etag(self, encoding: Optional[str]) -> str:
+        return f'{self.etag[:-1]}-{encoding}"' if encoding else self.etag
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+def cached_response(request: Request, payload: CachedPayload) -> Response:
+    encoding = negotiate(request.headers.get("accept-encoding"), payload.encoded)
+    etag = payload.variant_etag(encoding)
+    headers = {"ETag": etag, "Cache-Control": CATALOG_CACHE_CONTROL, "Vary": "Accept-Encoding"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+        return Response(content=payload.encoded[encoding], media_type="application/json", headers=headers)
+    return Response(content=payload.body, media_type="application/json", headers=headers)
+
+# Sorted listing views
+SORT_KEYS = {
+    "price": lambda product: product.final_price,
+    "discount": lambda product: product.discount,
+    "name": lambda product: product.name.casefold(),
+}
+
+class SortedView:
+    """Products ordered by (sort value, id), with parallel arrays for bisecting."""
+
+    def __init__(self, sort: str, products: List[Product], presorted: bool = False):
+        key = SORT_KEYS[sort]
+        self.sort = sort
+        self.products = products if presorted else sorted(products, key=lambda p: (key(p), p.id))
+        self.values = [key(p) for p in self.products]
+        self.keys = [(value, p.id) for value, p in zip(self.values, self.products)]
+
+    def filtered(self, predicate) -> "SortedView":
+        return SortedView(self.sort, [p for p in self.products if predicate(p)], presorted=True)
+
+    def page(self, lo_value=None, hi_value=None, after: Optional[tuple] = None,
+             descending: bool = False, limit: int = 20, predicate=None) -> tuple:
+        """Return up to ``limit`` products after the keyset ``after`` and whether more remain."""
+        lo = 0 if lo_value is None else bisect.bisect_left(self.values, lo_value)
+        hi = len(self.products) if hi_value is None else bisect.bisect_right(self.values, hi_value)
+        if descending:
+            if after is not None:
+                hi = min(hi, bisect.bisect_left(self.keys, after))
+            positions = range(hi - 1, lo - 1, -1)
+        else:
+            if after is not None:
+                lo = max(lo, bisect.bisect_right(self.keys, after))
+            positions = range(lo, hi)
+
+        items = []
+        for i in positions:
+            product = self.products[i]
+            if predicate and not predicate(product):
+                continue
+            if len(items) == limit:
+                return items, True
+            items.append(product)
+        return items, False
+
+# Search index
+NAME_TERM_WEIGHT = 3
+DESCRIPTION_TERM_WEIGHT = 1
+EXACT_TERM_BOOST = 2
+PREFIX_EXPANSION_LIMIT = 64
+SEARCH_SCAN_LIMIT = 2000
+# Posting lists up to this long are intersected up front instead of scanned
+SEARCH_INTERSECT_LIMIT = 5000
+SEARCH_REBUILD_THRESHOLD = 1000
+
+def tokenize(text: str) -> List[str]:
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+class SearchIndex:
+    """Inverted index over product names and category descriptions.
+
+    Every term keeps its postings both as a dict for membership checks and
+    as a list ranked by weight, so single-term type-ahead queries read the
+    top of a few ranked lists instead of scoring every match. Updates are
+    applied per product, keeping the sorted term list and ranked postings in
+    order without a rebuild.
+    """
+
+    def __init__(self):
+        self.terms: List[str] = []
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.ranked: Dict[str, List[tuple]] = {}
+        self.doc_terms: Dict[str, Dict[str, int]] = {}
+        self.doc_categories: Dict[str, str] = {}
+
+    @classmethod
+    def build(cls, products: List[Product], categories: Dict[str, Dict[str, str]]) -> "SearchIndex":
+        index = cls()
+        for product in products:
+            weights = index.doc_terms[product.id] = cls.document_terms(product, categories)
+            index.doc_categories[product.id] = product.category
+            for term, weight in weights.items():
+                index.postings.setdefault(term, {})[product.id] = weight
+        index.terms = sorted(index.postings)
+        index.ranked = {
+            term: sorted((-weight, product_id) for product_id, weight in postings.items())
+            for term, postings in index.postings.items()
+        }
+        return index
+
+    @staticmethod
+    def document_terms(product: Product, categories: Dict[str, Dict[str, str]]) -> Dict[str, int]:
+        weights: Dict[str, int] = {}
+        category = categories.get(product.category, {})
+        for term in tokenize(f"{category.get('name', '')} {category.get('description', '')}"):
+            weights[term] = DESCRIPTION_TERM_WEIGHT
+        for term in set(tokenize(product.name)):
+            weights[term] = weights.get(term, 0) + NAME_TERM_WEIGHT
+        return weights
+
+    def add(self, product: Product, categories: Dict[str, Dict[str, str]]):
+        if product.id in self.doc_terms:
+            self.remove(product.id)
+        weights = self.document_terms(product, categories)
+        self.doc_terms[product.id] = weights
+        self.doc_categories[product.id] = product.category
+        for term, weight in weights.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = {}
+                self.ranked[term] = []
+                bisect.insort(self.terms, term)
+            postings[product.id] = weight
+            bisect.insort(self.ranked[term], (-weight, product.id))
+
+    def remove(self, product_id: str):
+        weights = self.doc_terms.pop(product_id, None)
+        if weights is None:
+            return
+        self.doc_categories.pop(product_id, None)
+        for term, weight in weights.items():
+            del self.postings[term][product_id]
+            ranked = self.ranked[term]
+            del ranked[bisect.bisect_left(ranked, (-weight, product_id))]
+            if not ranked:
+                del self.postings[term]
+                del self.ranked[term]
+                del self.terms[bisect.bisect_left(self.terms, term)]
+
+    def expand(self, prefix: str) -> List[str]:
+        start = bisect.bisect_left(self.terms, prefix)
+        end = bisect.bisect_left(self.terms, prefix + "\uffff", start,
+                                 min(len(self.terms), start + PREFIX_EXPANSION_LIMIT))
+        return self.terms[start:end]
+
+    def search(self, query: str, category: Optional[str] = None, limit: int = 20) -> List[str]:
+        """Return product ids ranked by score; the last token also matches as a prefix."""
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        exact, last = tokens[:-1], tokens[-1]
+        if query[-1:].isspace():
+            exact, last = tokens, None
+
+        # Score multipliers per term: exact matches outrank prefix completions
+        last_terms = {}
+        if last is not None:
+            last_terms = {term: 1 for term in self.expand(last)}
+            if last in last_terms:
+                last_terms[last] = EXACT_TERM_BOOST
+            if not last_terms:
+                return []
+
+        if not exact:
+            return self._top_prefix(last_terms, category, limit)
+        if len(exact) == 1 and not last_terms:
+            if exact[0] not in self.postings:
+                return []
+            return self._top_prefix({exact[0]: EXACT_TERM_BOOST}, category, limit)
+
+        exact = list(dict.fromkeys(exact))
+        if any(term not in self.postings for term in exact):
+            return []
+        max_weight = lambda term: -self.ranked[term][0][0]
+        # Candidates come best first from the rarest exact term, or from the
+        # prefix completions when those are rarer; each carries the part of its
+        # score already known, and the rest is checked against the posting lists
+        driver = min(exact, key=lambda term: len(self.postings[term]))
+        completions = sum(len(self.postings[term]) for term in last_terms)
+        # Selective queries: intersect the posting lists in C first, so the scan
+        # below skips non-matches cheaply and a handful of matches is just scored
+        matched = None
+        if len(self.postings[driver]) <= SEARCH_INTERSECT_LIMIT:
+            matched = self._intersect(exact, last_terms if completions <= SEARCH_INTERSECT_LIMIT else {})
+        ordered = matched is None or len(matched) > 4 * limit
+        if matched is None and last_terms and completions < len(self.postings[driver]):
+            candidates = self._completion_candidates(last_terms)
+            checked = [self.postings[term] for term in exact]
+            max_rest = sum(max_weight(term) for term in exact) * EXACT_TERM_BOOST
+            last_postings = []
+        else:
+            driver_postings = self.postings[driver]
+            if not ordered:
+                candidates = ((-driver_postings[product_id] * EXACT_TERM_BOOST, product_id) for product_id in matched)
+            else:
+                candidates = ((weight * EXACT_TERM_BOOST, product_id) for weight, product_id in self.ranked[driver]
+                              if matched is None or product_id in matched)
+            checked = [self.postings[term] for term in exact if term != driver]
+            max_rest = sum(max_weight(term) for term in exact if term != driver) * EXACT_TERM_BOOST
+            last_postings = [(self.postings[term], boost) for term, boost in last_terms.items()]
+            if last_postings:
+                max_rest += max(max_weight(term) * boost for term, boost in last_terms.items())
+
+        # Best (-score, product_id) entries so far, kept sorted
+        top: List[tuple] = []
+        worst = None  # top[-1] once top holds limit entries
+        for known, product_id in itertools.islice(candidates, SEARCH_SCAN_LIMIT):
+            # Ranked candidates arrive by falling known score, then rising id: once
+            # even the best score this one could reach ranks below the top, stop.
+            # A few intersected matches come unordered and are all scored
+            if ordered and worst is not None and (known - max_rest, product_id) > worst:
+                break
+            if category and self.doc_categories[product_id] != category:
+                continue
+            score = -known
+            for postings in checked:
+                term_weight = postings.get(product_id)
+                if term_weight is None:
+                    break
+                score += term_weight * EXACT_TERM_BOOST
+            else:
+                if last_postings:
+                    # Match completions against whichever is shorter: the posting
+                    # lists of a narrow prefix, or the product's own few terms
+                    best = 0
+                    doc = self.doc_terms[product_id]
+                    if len(last_postings) < len(doc):
+                        for postings, boost in last_postings:
+                            completion = postings.get(product_id, 0) * boost
+                            if completion > best:
+                                best = completion
+                    else:
+                        for term, term_weight in doc.items():
+                            boost = last_terms.get(term)
+                            if boost and term_weight * boost > best:
+                                best = term_weight * boost
+                    if not best:
+                        continue
+                    score += best
+                entry = (-score, product_id)
+                if worst is None:
+                    bisect.insort(top, entry)
+                    if len(top) == limit:
+                        worst = top[-1]
+                elif entry < worst:
+                    top.pop()
+                    bisect.insort(top, entry)
+                    worst = top[-1]
+        return [product_id for _, product_id in top]
+
+    def _intersect(self, exact: List[str], last_terms: Dict[str, int]) -> set:
+        """Products holding every exact term and, if given, one of the completions."""
+        terms = sorted(exact, key=lambda term: len(self.postings[term]))
+        matched = set(self.postings[terms[0]])
+        for term in terms[1:]:
+            matched &= self.postings[term].keys()
+        if last_terms and matched:
+            matched &= set().union(*(self.postings[term] for term in last_terms))
+        return matched
+
+    def _completion_candidates(self, terms: Dict[str, int]):
+        """(-boosted weight, product id) across ``terms``, best first, each product once."""
+        def boosted(term: str, boost: int):
+            for weight, product_id in self.ranked[term]:
+                yield weight * boost, product_id
+
+        seen = set()
+        for key, product_id in heapq.merge(*(boosted(term, boost) for term, boost in terms.items())):
+            if product_id not in seen:
+                seen.add(product_id)
+                yield key, product_id
+
+    def _top_prefix(self, terms: Dict[str, int], category: Optional[str], limit: int) -> List[str]:
+        results = []
+        for _, product_id in self._completion_candidates(terms):
+            if category and self.doc_categories[product_id] != category:
+                continue
+            results.append(product_id)
+            if len(results) == limit:
+                break
+        return results
+
+    @staticmethod
+    def diff(previous: "CatalogIndex", current: "CatalogIndex") -> Optional[tuple]:
+        """(changed products, removed ids) between two catalogs, or None if a rebuild is cheaper.
+
+        Walks every product, so it runs in the worker thread that builds ``current``.
+        """
+        if previous.categories != current.categories:
+            return None
+        changed = [
+            product for product_id, product in current.by_id.items()
+            if (old := previous.by_id.get(product_id)) is None
+            or (old.name, old.category) != (product.name, product.category)
+        ]
+        removed = [product_id for product_id in previous.by_id if product_id not in current.by_id]
+        if len(changed) + len(removed) > SEARCH_REBUILD_THRESHOLD:
+            return None
+        return changed, removed
+
+    def apply(self, changes: tuple, categories: Dict[str, Dict[str, str]]):
+        """Patch in a diff; at most SEARCH_REBUILD_THRESHOLD products, so cheap enough for the loop."""
+        changed, removed = changes
+        for product_id in removed:
+            self.remove(product_id)
+        for product in changed:
+            self.add(product, categories)
+
+# Pricing engine
+def calculate_final_prices(original_prices: np.ndarray, discounts: np.ndarray) -> np.ndarray:
+    """Vectorized calculate_final_price with identical rounding."""
+    scaled = original_prices * (1 - discounts / 100) * 100
+    final_prices = np.rint(scaled) / 100
+    # Near a half cent the float product may sit on either side of the tie;
+    # defer those few values to the scalar round() so results match exactly
+    for i in np.flatnonzero(np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6):
+        final_prices[i] = calculate_final_price(float(original_prices[i]), int(discounts[i]))
+    return final_prices
+
+class PricingEngine:
+    """Catalog prices held as columns and repriced in one vectorized pass."""
+
+    def __init__(self, products: Dict[str, List[Dict[str, Any]]]):
+        rows = [(category, product) for category, items in products.items() for product in items]
+        self.positions = {product["id"]: i for i, (_, product) in enumerate(rows)}
+        self.category_codes = {category: code for code, category in enumerate(products)}
+        self.categories = np.array([self.category_codes[category] for category, _ in rows], dtype=np.int32)
+        self.original_prices = np.array([product["original_price"] for _, product in rows], dtype=np.float64)
+        self.discounts = np.array([product["discount"] for _, product in rows], dtype=np.int64)
+
+    def promotion_mask(self, promotion: Promotion) -> np.ndarray:
+        mask = np.zeros(len(self.positions), dtype=bool)
+        if promotion.category is not None:
+            code = self.category_codes.get(promotion.category)
+            if code is not None:
+                mask |= self.categories == code
+        if promotion.product_ids:
+            positions = [self.positions[pid] for pid in promotion.product_ids if pid in self.positions]
+            mask[positions] = True
+        if promotion.category is None and promotion.product_ids is None:
+            mask[:] = True
+        return mask
+
+    def price(self, promotions: List[Promotion], now: datetime) -> tuple:
+        """Return (effective discounts, final prices); overlapping promotions don't stack."""
+        extra = np.zeros(len(self.positions), dtype=np.int64)
+        for promotion in promotions:
+            if promotion.is_active(now):
+                mask = self.promotion_mask(promotion)
+                extra[mask] = np.maximum(extra[mask], promotion.extra_discount)
+        discounts = np.minimum(self.discounts + extra, 100)
+        return discounts, calculate_final_prices(self.original_prices, discounts)
+
+def next_price_change(promotions: List[Promotion], now: datetime) -> Optional[datetime]:
+    boundaries = [
+        moment for promotion in promotions
+        for moment in (promotion.starts_at, promotion.ends_at)
+        if moment is not None and moment > now
+    ]
+    return min(boundaries, default=None)
+
+# Product image derivatives
+IMAGE_ORIGINALS_DIR = Path(os.environ.get('IMAGE_ORIGINALS_DIR', str(ROOT_DIR / 'images' / 'originals')))
+IMAGE_CACHE_DIR = Path(os.environ.get('IMAGE_CACHE_DIR', str(ROOT_DIR / 'images' / 'cache')))
+# Budget for the whole IMAGE_CACHE_DIR, shared by every worker
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_MAX_MB', '512')) * 1024 * 1024
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', str(os.cpu_count() or 2)))
+IMAGE_WIDTHS = (160, 320, 480, 640, 960, 1280)
+IMAGE_THUMBNAIL_WIDTH = 480
+IMAGE_QUALITY = int(os.environ.get('IMAGE_QUALITY', '80'))
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+image_derivatives = ImageDerivatives(IMAGE_ORIGINALS_DIR, IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES, IMAGE_WORKERS,
+                                     IMAGE_WIDTHS, IMAGE_QUALITY)
+
+# Catalog index
+class CatalogIndex:
+    """Lookup tables built once from the catalog so requests never scan it."""
+
+    def __init__(self, categories: Dict[str, Dict[str, str]], products: Dict[str, List[Dict[str, Any]]],
+                 promotions: Optional[List[Promotion]] = None, build_search: bool = True,
+                 image_originals: Optional[Dict[str, tuple]] = None):
+        now = datetime.utcnow()
+        promotions = promotions or []
+        self.image_originals = image_originals or {}
+        self.categories = categories
+        self.by_id: Dict[str, Product] = {}
+        self.by_category: Dict[str, List[Product]] = {}
+        self.pricing = PricingEngine(products)
+        self.next_price_change = next_price_change(promotions, now)
+
+        discounts, final_prices = self.pricing.price(promotions, now)
+        discounts, final_prices = discounts.tolist(), final_prices.tolist()
+        position = 0
+        for category, items in products.items():
+            built = []
+            for product in items:
+                entry = Product(
+                    id=product["id"],
+                    name=product["name"],
+                    original_price=product["original_price"],
+                    discount=discounts[position],
+                    final_price=final_prices[position],
+                    image=product["image"],
+                    category=category,
+                    is_account=product.get("is_account", False),
+                    verified=product.get("verified", False)
+                )
+                original = self.image_originals.get(entry.id)
+                if original:
+                    entry.thumbnail = image_derivatives.url(entry.id, original[1], IMAGE_THUMBNAIL_WIDTH)
+                    entry.image_srcset = image_derivatives.srcset(entry.id, original[1])
+                self.by_id[entry.id] = entry
+                built.append(entry)
+                position += 1
+            self.by_category[category] = built
+
+        self.categories_payload = CachedPayload(categories)
+        self.category_payloads = {
+            category: CachedPayload(built)
+            for category, built in self.by_category.items()
+        }
+        self.sorted_views = {
+            (category, sort, None, None): SortedView(sort, built)
+            for category, built in self.by_category.items()
+            for sort in SORT_KEYS
+        }
+        self.search = SearchIndex.build(list(self.by_id.values()), categories) if build_search else None
+
+    def get_product(self, product_id: str) -> Optional[Product]:
+        return self.by_id.get(product_id)
+
+    def get_category(self, category: str) -> Optional[List[Product]]:
+        return self.by_category.get(category)
+
+    def get_sorted_view(self, category: str, sort: str, verified: Optional[bool] = None,
+                        is_account: Optional[bool] = None) -> SortedView:
+        """Sorted view for a flag combination, derived once from the unfiltered view."""
+        key = (category, sort, verified, is_account)
+        view = self.sorted_views.get(key)
+        if view is None:
+            view = self.sorted_views[(category, sort, None, None)].filtered(
+                lambda p: (verified is None or p.verified == verified)
+                and (is_account is None or p.is_account == is_account)
+            )
+            self.sorted_views[key] = view
+        return view
+
+def encode_cursor(sort: str, order: str, product: Product) -> str:
+    raw = json.dumps([sort, order, SORT_KEYS[sort](product), product.id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, sort: str, order: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, cursor_order, value, product_id = json.loads(raw)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    # The value is compared with sort keys, so a wrong type would fail there instead of here
+    if sort == "name":
+        valid_value = isinstance(value, str)
+    else:
+        valid_value = isinstance(value, (int, float)) and not isinstance(value, bool)
+    if not isinstance(product_id, str) or not valid_value:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if cursor_sort != sort or cursor_order != order:
+        raise HTTPException(status_code=400, detail="Cursor does not match sort order")
+    return (value, product_id)
+
+# Mongo-backed catalog
+CATALOG_POLL_INTERVAL = float(os.environ.get('CATALOG_POLL_INTERVAL', '5'))
+# Change events are coalesced until the stream is quiet this long, or for at most the max delay
+CATALOG_RELOAD_DEBOUNCE = float(os.environ.get('CATALOG_RELOAD_DEBOUNCE', '0.5'))
+CATALOG_RELOAD_MAX_DELAY = float(os.environ.get('CATALOG_RELOAD_MAX_DELAY', '5'))
+
+class CatalogStore:
+    """Holds the live catalog snapshot and swaps it when Mongo changes.
+
+    Handlers only ever read ``current``; reloads build a new index off the
+    event loop and replace the reference in one assignment.
+    """
+
+    def __init__(self, initial: CatalogIndex):
+        self.current = initial
+        self.version: Optional[int] = None
+        self._source: Optional[tuple] = None
+        self._watcher: Optional[asyncio.Task] = None
+        self._repricer: Optional[asyncio.Task] = None
+        self._resume_token: Optional[Dict[str, Any]] = None
+        self._stream_opened = False
+
+    async def seed(self):
+        """Insert the bundled catalog if the collections are still empty.
+
+        Upserts rely on the unique indexes from db_indexes to stay idempotent
+        when several workers seed at once.
+        """
+        if await db.categories.estimated_document_count() == 0:
+            await db.categories.bulk_write([
+                UpdateOne({"key": key}, {"$setOnInsert": {"key": key, **category}}, upsert=True)
+                for key, category in PRODUCT_CATEGORIES.items()
+            ])
+        if await db.products.estimated_document_count() == 0:
+            await db.products.bulk_write([
+                UpdateOne({"id": product["id"]}, {"$setOnInsert": {**product, "category": category}}, upsert=True)
+                for category, products in PRODUCTS.items()
+                for product in products
+            ])
+
+    async def reload(self):
+        categories = {}
+        async for doc in db.categories.find({}, {"_id": 0}):
+            categories[doc.pop("key")] = doc
+        products: Dict[str, List[Dict[str, Any]]] = {key: [] for key in categories}
+        async for doc in db.products.find({}, {"_id": 0}).sort("id", 1):
+            products.setdefault(doc.pop("category"), []).append(doc)
+        promotions = [
+            Promotion(**doc) async for doc in db.promotions.find(
+                {"$or": [{"ends_at": None}, {"ends_at": {"$gt": datetime.utcnow()}}]}, {"_id": 0}
+            )
+        ]
+        meta = await db.catalog_meta.find_one({"_id": "version"})
+
+        self._source = (categories, products, promotions)
+        await self.rebuild()
+        self.version = meta["version"] if meta else 0
+        logger.info(f"Catalog loaded: {len(self.current.by_id)} products, "
+                    f"{len(promotions)} promotions, version {self.version}")
+
+    async def rebuild(self):
+        """Reprice and re-index the last loaded source data, then swap it in."""
+        categories, products, promotions = self._source
+        previous = self.current
+        index, changes = await asyncio.to_thread(self._build_index, categories, products, promotions, previous)
+        # Small edits patch the live search index in place, on the loop so no
+        # search sees it half-updated; price-only reloads have nothing to patch
+        if changes is not None:
+            previous.search.apply(changes, categories)
+            index.search = previous.search
+        else:
+            index.search = await asyncio.to_thread(SearchIndex.build, list(index.by_id.values()), categories)
+
+        self.current = index
+        self._schedule_reprice(index.next_price_change)
+
+    @staticmethod
+    def _build_index(categories, products, promotions, previous: CatalogIndex) -> tuple:
+        """Build the next catalog and its search diff against ``previous``, off the event loop."""
+        # Originals are rescanned on every rebuild, so new images show up on the next reload
+        index = CatalogIndex(categories, products, promotions, False, image_derivatives.scan_originals())
+        return index, SearchIndex.diff(previous, index)
+
+    def _schedule_reprice(self, when: Optional[datetime]):
+        """Rebuild when the next promotion starts or ends."""
+        if self._repricer and self._repricer is not asyncio.current_task():
+            self._repricer.cancel()
+        self._repricer = asyncio.create_task(self._reprice_at(when)) if when else None
+
+    async def _reprice_at(self, when: datetime):
+        await asyncio.sleep(max(0.0, (when - datetime.utcnow()).total_seconds()))
+        await self.rebuild()
+
+    async def preload(self):
+        """Load the catalog before workers fork, so they share its pages copy-on-write."""
+        await self.seed()
+        await self.reload()
+        # The repricer task belonged to the preloading event loop; start() reschedules it
+        self._repricer = None
+
+    async def start(self):
+        try:
+            if self.version is None:
+                await self.seed()
+                await self.reload()
+            else:
+                # Preloaded before fork: keep the shared index unless the catalog moved on since
+                meta = await db.catalog_meta.find_one({"_id": "version"})
+                if (meta["version"] if meta else 0) != self.version:
+                    await self.reload()
+                else:
+                    self._schedule_reprice(self.current.next_price_change)
+        except Exception as e:
+            logger.error(f"Catalog load failed, serving bundled catalog: {e}")
+        self._watcher = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        for task in (self._watcher, self._repricer):
+            if task:
+                task.cancel()
+        self._watcher = self._repricer = None
+
+    async def _watch(self):
+        while True:
+            try:
+                if self.version is None:
+                    await self.seed()
+                    await self.reload()
+                await self._watch_change_stream()
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                if self._resume_token is not None:
+                    # Typically the resume point has rolled off the oplog; reopen
+                    # without it, which reloads to cover the gap
+                    logger.warning(f"Catalog change stream could not resume: {e}")
+                    self._resume_token = None
+                    continue
+                # Change streams need a replica set; poll the version document otherwise
+                logger.info("Change streams unavailable, polling catalog version")
+                await self._poll_version()
+            except Exception as e:
+                logger.error(f"Catalog watcher failed: {e}")
+                await asyncio.sleep(CATALOG_POLL_INTERVAL)
+
+    async def _watch_change_stream(self):
+        """Reload once per burst of changes, resuming after the last one seen on reconnect."""
+        pipeline = [{"$match": {"ns.coll": {"$in": ["categories", "products", "promotions", "catalog_meta"]}}}]
+        async with db.watch(pipeline, resume_after=self._resume_token,
+                            max_await_time_ms=int(CATALOG_RELOAD_DEBOUNCE * 1000)) as stream:
+            if self._stream_opened and self._resume_token is None:
+                # Reopened with nothing to resume from, so changes made while closed would be missed
+                await self.reload()
+            self._stream_opened = True
+            self._resume_token = stream.resume_token
+            async for _ in stream:
+                # A bulk edit or the seed arrives as many events: drain them, then reload once
+                deadline = time.monotonic() + CATALOG_RELOAD_MAX_DELAY
+                while time.monotonic() < deadline and await stream.try_next() is not None:
+                    pass
+                await self.reload()
+                self._resume_token = stream.resume_token
+
+    async def _poll_version(self):
+        while True:
+            await asyncio.sleep(CATALOG_POLL_INTERVAL)
+            meta = await db.catalog_meta.find_one({"_id": "version"})
+            if (meta["version"] if meta else 0) != self.version:
+                await self.reload()
+
+async def bump_catalog_version():
+    """Signal every worker to reload; needed when change streams are unavailable."""
+    await db.catalog_meta.update_one({"_id": "version"}, {"$inc": {"version": 1}}, upsert=True)
+
+async def create_promotion(extra_discount: int, category: Optional[str] = None,
+                           product_ids: Optional[List[str]] = None, ends_at: Optional[datetime] = None,
+                           starts_at: Optional[datetime] = None) -> Promotion:
+    """Add ``extra_discount`` percent off a category, a set of products, or everything."""
+    promotion = Promotion(extra_discount=extra_discount, category=category, product_ids=product_ids,
+                          ends_at=ends_at, starts_at=starts_at or datetime.utcnow())
+    await db.promotions.insert_one(promotion.model_dump())
+    await bump_catalog_version()
+    return promotion
+
+# Serve the bundled catalog until the Mongo snapshot is loaded at startup
+catalog_store = CatalogStore(CatalogIndex(PRODUCT_CATEGORIES, PRODUCTS))
+
+# Sessions
+SESSION_LIFETIME = timedelta(days=7)
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '10000'))
+SESSION_CACHE_TTL = float(os.environ.get('SESSION_CACHE_TTL', '60'))
+SESSION_NEGATIVE_TTL = float(os.environ.get('SESSION_NEGATIVE_TTL', '30'))
+
+# Token -> Session, or None for tokens known to be invalid. Revocation in
+# another worker is picked up once the local entry's TTL runs out.
+session_cache = TTLCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+bearer_scheme = HTTPBearer(auto_error=False)
+
+def cache_session(session: Session):
+    remaining = (session.expires_at - datetime.utcnow()).total_seconds()
+    session_cache.set(session.token, session, min(SESSION_CACHE_TTL, remaining))
+
+async def create_session(user: Dict[str, Any], ip_address: str, device_fingerprint: str) -> Session:
+    session = Session(
+        token=generate_session_token(),
+        user_id=user["id"],
+        email=user["email"],
+        expires_at=datetime.utcnow() + SESSION_LIFETIME
+    )
+    await db.sessions.insert_one({
+        "_id": session.token,
+        "user_id": session.user_id,
+        "email": session.email,
+        "ip_address": ip_address,
+        "device_fingerprint": device_fingerprint,
+        "created_at": datetime.utcnow(),
+        "expires_at": session.expires_at
+    })
+    cache_session(session)
+    return session
+
+async def resolve_session(token: str) -> Optional[Session]:
+    session = session_cache.get(token)
+    if session is TTLCache.MISSING:
+        doc = await db.sessions.find_one(
+            {"_id": token, "expires_at": {"$gt": datetime.utcnow()}},
+            {"user_id": 1, "email": 1, "expires_at": 1}
+        )
+        if doc:
+            session = Session(token=token, user_id=doc["user_id"], email=doc["email"], expires_at=doc["expires_at"])
+            cache_session(session)
+        else:
+            session = None
+            session_cache.set(token, None, SESSION_NEGATIVE_TTL)
+    if session and session.expires_at <= datetime.utcnow():
+        session_cache.pop(token)
+        return None
+    return session
+
+async def revoke_session(token: str):
+    session_cache.pop(token)
+    await db.sessions.delete_one({"_id": token})
+
+async def get_current_session(credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer_scheme)) -> Session:
+    """Resolve the bearer token; cached sessions cost no Mongo round trip."""
+    session = await resolve_session(credentials.credentials) if credentials else None
+    if not session:
+        raise HTTPException(status_code=401, detail="Invalid or expired session",
+                            headers={"WWW-Authenticate": "Bearer"})
+    return session
+
+# Affiliate codes
+# Keys the code permutation: anyone holding it can enumerate every issued code, so it is never committed
+AFFILIATE_CODE_SECRET = os.environ.get('AFFILIATE_CODE_SECRET', '').encode()
+if not AFFILIATE_CODE_SECRET:
+    raise RuntimeError("AFFILIATE_CODE_SECRET is not set; generate one with "
+                       "`python -c 'import secrets; print(secrets.token_urlsafe(32))'`")
+AFFILIATE_CODE_BLOCK_SIZE = int(os.environ.get('AFFILIATE_CODE_BLOCK_SIZE', '100'))
+AFFILIATE_CODE_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"  # Crockford base32
+AFFILIATE_CODE_LENGTH = 6
+AFFILIATE_CODE_HALF_BITS = AFFILIATE_CODE_LENGTH * 5 // 2
+
+def encode_affiliate_code(sequence: int) -> str:
+    """Map a counter value to a code through a keyed Feistel permutation.
+
+    The permutation is a bijection on 30-bit values, so distinct sequence
+    numbers always give distinct codes, while consecutive numbers come out
+    looking unrelated.
+    """
+    if not 0 <= sequence < 1 << (2 * AFFILIATE_CODE_HALF_BITS):
+        raise ValueError("Affiliate code space exhausted")
+    mask = (1 << AFFILIATE_CODE_HALF_BITS) - 1
+    left, right = sequence >> AFFILIATE_CODE_HALF_BITS, sequence & mask
+    for round_number in range(4):
+        digest = hmac.new(AFFILIATE_CODE_SECRET, f"{round_number}:{right}".encode(), hashlib.sha256).digest()
+        left, right = right, left ^ (int.from_bytes(digest[:4], "big") & mask)
+    value = (left << AFFILIATE_CODE_HALF_BITS) | right
+
+    chars = []
+    for _ in range(AFFILIATE_CODE_LENGTH):
+        value, index = divmod(value, 32)
+        chars.append(AFFILIATE_CODE_ALPHABET[index])
+    return "LUX" + "".join(reversed(chars))
+
+class AffiliateCodeAllocator:
+    """Hands out codes from a block of the shared counter reserved per worker.
+
+    One find_one_and_update reserves AFFILIATE_CODE_BLOCK_SIZE sequence
+    numbers, so codes are allocated in O(1) without collision retries; the
+    unique index on affiliates.unique_code remains as a backstop.
+    """
+
+    def __init__(self, block_size: int):
+        self.block_size = block_size
+        self.next = self.end = 0
+        self._lock: Optional[asyncio.Lock] = None
+
+    def start(self):
+        self._lock = asyncio.Lock()
+
+    async def allocate(self) -> str:
+        async with self._lock:
+            if self.next >= self.end:
+                counter = await db.counters.find_one_and_update(
+                    {"_id": "affiliate_code"},
+                    {"$inc": {"value": self.block_size}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+                self.end = counter["value"]
+                self.next = self.end - self.block_size
+            sequence = self.next
+            self.next += 1
+        return encode_affiliate_code(sequence)
+
+affiliate_codes = AffiliateCodeAllocator(AFFILIATE_CODE_BLOCK_SIZE)
+
+# Affiliate click tracking
+CLICK_FLUSH_INTERVAL = float(os.environ.get('CLICK_FLUSH_INTERVAL', '2'))
+CLICK_BUFFER_MAX_CODES = int(os.environ.get('CLICK_BUFFER_MAX_CODES', '50000'))
+AFFILIATE_REDIRECT_URL = os.environ.get('AFFILIATE_REDIRECT_URL', '/')
+AFFILIATE_CODE_PATTERN = re.compile(r"^LUX[0-9A-Z]{4,6}$")
+
+class ClickBuffer:
+    """Per-worker click counters flushed to Mongo as one bulk $inc.
+
+    Recording a click is a dict increment; at most CLICK_FLUSH_INTERVAL
+    seconds of clicks are lost if the worker dies without a clean shutdown.
+    """
+
+    def __init__(self, interval: float, max_codes: int):
+        self.interval = interval
+        self.max_codes = max_codes
+        self.pending: Dict[str, int] = {}
+        self.flushed = 0
+        self._full: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._flushing: Optional[asyncio.Task] = None
+
+    def record(self, code: str):
+        self.pending[code] = self.pending.get(code, 0) + 1
+        if len(self.pending) >= self.max_codes and self._full:
+            self._full.set()
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        if self._full:
+            self._full.clear()
+        try:
+            await db.affiliates.bulk_write(
+                [UpdateOne({"unique_code": code}, {"$inc": {"total_clicks": count}}) for code, count in batch.items()],
+                ordered=False
+            )
+            self.flushed += sum(batch.values())
+        except Exception as e:
+            # Keep the counts for the next attempt rather than dropping them
+            logger.error(f"Click flush failed: {e}")
+            for code, count in batch.items():
+                self.pending[code] = self.pending.get(code, 0) + count
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            # Shielded: its batch is already out of pending, so cancelling the
+            # write would lose the counts; stop() waits for it instead
+            self._flushing = asyncio.create_task(self.flush())
+            await asyncio.shield(self._flushing)
+
+    def start(self):
+        self._full = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._flushing:
+            await self._flushing
+            self._flushing = None
+        await self.flush()
+
+click_buffer = ClickBuffer(CLICK_FLUSH_INTERVAL, CLICK_BUFFER_MAX_CODES)
+
+# Affiliate dashboard cache
+DASHBOARD_CACHE_SIZE = int(os.environ.get('DASHBOARD_CACHE_SIZE', '10000'))
+DASHBOARD_CACHE_TTL = float(os.environ.get('DASHBOARD_CACHE_TTL', '10'))
+
+# Affiliate code -> dashboard summary, or None for unknown codes. Writes in
+# this worker invalidate entries; other workers see them within the TTL.
+dashboard_cache = TTLCache(DASHBOARD_CACHE_SIZE, DASHBOARD_CACHE_TTL)
+
+async def migrate_withdrawal_history():
+    """Move embedded withdrawal_history arrays into the withdrawals collection, once.
+
+    Each entry is upserted under an _id derived from its affiliate and
+    position, so workers that run the migration concurrently, or a rerun
+    after a crash, never insert an entry twice.
+    """
+    if await db.migrations.find_one({"_id": "withdrawal_history"}):
+        return
+    moved = 0
+    async for affiliate in db.affiliates.find(
+        {"withdrawal_history.0": {"$exists": True}}, {"_id": 0, "unique_code": 1, "paypal_email": 1,
+                                                      "created_at": 1, "withdrawal_history": 1}
+    ):
+        code = affiliate["unique_code"]
+        upserts = []
+        for position, entry in enumerate(affiliate["withdrawal_history"]):
+            migrated_id = f"withdrawal_history:{code}:{position}"
+            upserts.append(UpdateOne({"_id": migrated_id}, {"$setOnInsert": {
+                "id": str(uuid.uuid5(uuid.NAMESPACE_URL, migrated_id)),
+                "affiliate_code": code,
+                "paypal_email": affiliate["paypal_email"],
+                "status": "pending",
+                "requested_at": affiliate["created_at"],
+                **entry
+            }}, upsert=True))
+        try:
+            result = await db.withdrawals.bulk_write(upserts, ordered=False)
+            moved += result.upserted_count
+        except BulkWriteError as e:
+            # A concurrent run inserted the same entries first
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+            moved += e.details["nUpserted"]
+    await db.affiliates.update_many({"withdrawal_history": {"$exists": True}}, {"$unset": {"withdrawal_history": ""}})
+    await db.migrations.update_one({"_id": "withdrawal_history"},
+                                   {"$set": {"applied_at": datetime.utcnow(), "moved": moved}}, upsert=True)
+    logger.info(f"Moved {moved} embedded withdrawals into the withdrawals collection")
+
+# Affiliate attribution
+ATTRIBUTION_INTERVAL = float(os.environ.get('ATTRIBUTION_INTERVAL', '5'))
+ATTRIBUTION_BATCH_SIZE = int(os.environ.get('ATTRIBUTION_BATCH_SIZE', '500'))
+ATTRIBUTION_SETTLE_SECONDS = float(os.environ.get('ATTRIBUTION_SETTLE_SECONDS', '5'))
+ATTRIBUTION_LEASE_SECONDS = 30
+
+def commission_rate_for(base_rate: float, total_sales: int) -> float:
+    """Current commission rate: base + 1% per 10 attributed sales."""
+    return base_rate + (total_sales // 10) * 1.0
+
+def order_key(order: Dict[str, Any]) -> tuple:
+    return (order["created_at"], order["id"])
+
+class AttributionPipeline:
+    """Folds affiliate orders into per-affiliate sales and commission counters.
+
+    The orders collection is the durable queue: orders carrying an
+    affiliate code are consumed in (created_at, id) order past a global
+    checkpoint in ``attribution_state``. Each affiliate also stores the key
+    of the last order applied to it, and every increment is conditioned on
+    that checkpoint, so replaying a batch after a crash never double counts.
+    A lease in the state document keeps one worker consuming at a time.
+    Every order with an affiliate code counts when created; there is no
+    payment confirmation step to wait for.
+    """
+
+    def __init__(self, interval: float, batch_size: int):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.orders_processed = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def acquire_lease(self, take_over: bool = False) -> Optional[Dict[str, Any]]:
+        now = datetime.utcnow()
+        query: Dict[str, Any] = {"_id": "orders"}
+        if not take_over:
+            query["$or"] = [
+                {"lease_owner": self.worker_id},
+                {"lease_expires": {"$lt": now}},
+                {"lease_expires": None}
+            ]
+        try:
+            return await db.attribution_state.find_one_and_update(
+                query,
+                {"$set": {"lease_owner": self.worker_id,
+                          "lease_expires": now + timedelta(seconds=ATTRIBUTION_LEASE_SECONDS)}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # Another worker holds the lease
+            return None
+
+    async def release_lease(self):
+        await db.attribution_state.update_one(
+            {"_id": "orders", "lease_owner": self.worker_id}, {"$set": {"lease_expires": None}}
+        )
+
+    async def process_batch(self, checkpoint: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Apply the next batch; returns the new checkpoint or None when caught up."""
+        query: Dict[str, Any] = {
+            "affiliate_code": {"$type": "string"},
+            "created_at": {"$lte": datetime.utcnow() - timedelta(seconds=ATTRIBUTION_SETTLE_SECONDS)}
+        }
+        if checkpoint:
+            query["$or"] = [
+                {"created_at": {"$gt": checkpoint["created_at"]}},
+                {"created_at": checkpoint["created_at"], "id": {"$gt": checkpoint["id"]}}
+            ]
+        orders = await db.orders.find(
+            query, {"_id": 0, "id": 1, "created_at": 1, "affiliate_code": 1, "final_price": 1}
+        ).sort([("created_at", 1), ("id", 1)]).limit(self.batch_size).to_list(self.batch_size)
+        if not orders:
+            return None
+
+        by_affiliate: Dict[str, List[Dict[str, Any]]] = {}
+        for order in orders:
+            by_affiliate.setdefault(order["affiliate_code"], []).append(order)
+        affiliates = {
+            doc["unique_code"]: doc
+            async for doc in db.affiliates.find(
+                {"unique_code": {"$in": list(by_affiliate)}},
+                {"_id": 0, "unique_code": 1, "commission_rate": 1, "total_sales": 1, "attribution_checkpoint": 1}
+            )
+        }
+
+        updates = []
+        for code, affiliate_orders in by_affiliate.items():
+            affiliate = affiliates.get(code)
+            if not affiliate:
+                continue
+            applied = affiliate.get("attribution_checkpoint")
+            if applied:
+                affiliate_orders = [o for o in affiliate_orders if order_key(o) > order_key(applied)]
+            if not affiliate_orders:
+                continue
+            sales = affiliate["total_sales"]
+            commission = 0.0
+            for order in affiliate_orders:
+                rate = commission_rate_for(affiliate["commission_rate"], sales)
+                commission += round(order["final_price"] * rate / 100, 2)
+                sales += 1
+            last = affiliate_orders[-1]
+            updates.append(UpdateOne(
+                {"unique_code": code, "attribution_checkpoint": applied},
+                {
+                    "$inc": {
+                        "total_sales": len(affiliate_orders),
+                        "commission_earned": round(commission, 2),
+                        "commission_balance": round(commission, 2)
+                    },
+                    "$set": {"attribution_checkpoint": {"created_at": last["created_at"], "id": last["id"]}}
+                }
+            ))
+        if updates:
+            result = await db.affiliates.bulk_write(updates, ordered=False)
+            if result.matched_count < len(updates):
+                logger.warning(f"Attribution skipped {len(updates) - result.matched_count} affiliates "
+                               "whose checkpoint moved concurrently")
+            for code in by_affiliate:
+                dashboard_cache.pop(code)
+
+        last = orders[-1]
+        new_checkpoint = {"created_at": last["created_at"], "id": last["id"]}
+        await db.attribution_state.update_one(
+            {"_id": "orders", "lease_owner": self.worker_id}, {"$set": {"checkpoint": new_checkpoint}}
+        )
+        self.orders_processed += len(orders)
+        return new_checkpoint
+
+    async def run_once(self) -> int:
+        """Consume everything currently available; returns the number of batches."""
+        state = await self.acquire_lease()
+        if not state:
+            return 0
+        checkpoint = state.get("checkpoint")
+        batches = 0
+        while True:
+            checkpoint = await self.process_batch(checkpoint)
+            if checkpoint is None:
+                return batches
+            batches += 1
+            # Renew before each batch; a worker that lost the lease must not keep
+            # moving per-affiliate checkpoints alongside the one that took over
+            if not await self.acquire_lease():
+                logger.warning(f"Attribution worker {self.worker_id} lost its lease")
+                return batches
+
+    async def rebuild(self, take_over: bool = False) -> int:
+        """Recompute every affiliate's counters from the full order history.
+
+        A windowed aggregation numbers each affiliate's orders to price every
+        sale at the commission tier it was made in; per-affiliate totals are
+        written back in batches and the global checkpoint moves to the newest
+        order counted. Needs MongoDB 5.0+ for $setWindowFields.
+
+        ``take_over`` claims the lease even from a live worker. A batch that
+        worker still has in flight cannot double count: its increments are
+        conditioned on the per-affiliate checkpoints this rewrites. The
+        lease is released when the rebuild finishes.
+        """
+        if not await self.acquire_lease(take_over):
+            raise RuntimeError("Attribution lease is held by another worker")
+        try:
+            return await self._rebuild()
+        finally:
+            await self.release_lease()
+
+    async def _rebuild(self) -> int:
+        tier = {"$floor": {"$divide": [{"$subtract": ["$position", 1]}, 10]}}
+        pipeline = [
+            {"$match": {"affiliate_code": {"$type": "string"}}},
+            {"$setWindowFields": {
+                "partitionBy": "$affiliate_code",
+                "sortBy": {"created_at": 1, "id": 1},
+                "output": {"position": {"$documentNumber": {}}}
+            }},
+            {"$lookup": {
+                "from": "affiliates",
+                "localField": "affiliate_code",
+                "foreignField": "unique_code",
+                "pipeline": [{"$project": {"_id": 0, "commission_rate": 1}}],
+                "as": "affiliate"
+            }},
+            {"$unwind": "$affiliate"},
+            {"$sort": {"affiliate_code": 1, "created_at": 1, "id": 1}},
+            {"$group": {
+                "_id": "$affiliate_code",
+                "sales": {"$sum": 1},
+                "earned": {"$sum": {"$round": [{"$divide": [
+                    {"$multiply": ["$final_price", {"$add": ["$affiliate.commission_rate", tier]}]}, 100
+                ]}, 2]}},
+                "last_created_at": {"$last": "$created_at"},
+                "last_id": {"$last": "$id"}
+            }}
+        ]
+        totals = {}
+        global_last = None
+        async for row in db.orders.aggregate(pipeline, allowDiskUse=True):
+            last = {"created_at": row["last_created_at"], "id": row["last_id"]}
+            totals[row["_id"]] = (row["sales"], round(row["earned"], 2), last)
+            if global_last is None or order_key(last) > order_key(global_last):
+                global_last = last
+
+        updates = []
+        async for doc in db.affiliates.find({}, {"_id": 0, "unique_code": 1}):
+            sales, earned, last = totals.get(doc["unique_code"], (0, 0.0, None))
+            updates.append(UpdateOne({"unique_code": doc["unique_code"]}, [{"$set": {
+                "total_sales": sales,
+                "commission_earned": earned,
+                "commission_balance": {"$subtract": [earned, {"$ifNull": ["$commission_withdrawn", 0]}]},
+                "attribution_checkpoint": last
+            }}]))
+        for start in range(0, len(updates), self.batch_size):
+            await db.affiliates.bulk_write(updates[start:start + self.batch_size], ordered=False)
+        dashboard_cache.clear()
+        await db.attribution_state.update_one(
+            {"_id": "orders", "lease_owner": self.worker_id}, {"$set": {"checkpoint": global_last}}
+        )
+        logger.info(f"Attribution rebuilt for {len(updates)} affiliates")
+        return len(updates)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Attribution run failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Hand the lease over now rather than making the next worker wait out the TTL
+        try:
+            await self.release_lease()
+        except Exception as e:
+            logger.error(f"Attribution lease release failed: {e}")
+
+attribution = AttributionPipeline(ATTRIBUTION_INTERVAL, ATTRIBUTION_BATCH_SIZE)
+
+async def get_optional_session(credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer_scheme)) -> Optional[Session]:
+    """Like get_current_session, but anonymous or stale tokens resolve to None."""
+    return await resolve_session(credentials.credentials) if credentials else None
+
+# Idempotency keys
+IDEMPOTENCY_KEY_TTL = timedelta(hours=int(os.environ.get('IDEMPOTENCY_KEY_TTL_HOURS', '24')))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', '10000'))
+IDEMPOTENCY_WAIT_SECONDS = 10.0
+# A claim not completed within this long is assumed dead and may be taken over
+IDEMPOTENCY_CLAIM_TIMEOUT = timedelta(seconds=int(os.environ.get('IDEMPOTENCY_CLAIM_TIMEOUT_SECONDS', '60')))
+
+class IdempotencyStore:
+    """Runs an operation at most once per key and replays its first response.
+
+    Concurrent duplicates in one worker await the same future; across
+    workers, inserting the key document is the claim, so only the claimant
+    runs the operation while the others wait for the stored response.
+    Completed responses are kept in the TTL-indexed idempotency_keys
+    collection, fronted by an in-process cache. A claim carries a deadline:
+    if its worker dies before completing, a retry after the deadline takes
+    the claim over instead of getting 409 until the key expires.
+    """
+
+    def __init__(self, cache_size: int, ttl: timedelta):
+        self.ttl = ttl
+        self.cache = TTLCache(cache_size, ttl.total_seconds())
+        self.inflight: Dict[str, asyncio.Future] = {}
+
+    @staticmethod
+    def fingerprint(payload: str) -> str:
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    async def run(self, key: str, payload: str, operation) -> Dict[str, Any]:
+        fingerprint = self.fingerprint(payload)
+        stored = self.cache.get(key)
+        if stored is TTLCache.MISSING:
+            inflight = self.inflight.get(key)
+            if inflight:
+                stored = await asyncio.shield(inflight)
+            else:
+                stored = await self._run_once(key, fingerprint, operation)
+        stored_fingerprint, response = stored
+        if stored_fingerprint != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+        return response
+
+    async def _run_once(self, key: str, fingerprint: str, operation) -> tuple:
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        try:
+            stored = await self._claim_and_run(key, fingerprint, operation)
+            future.set_result(stored)
+            return stored
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # waiters re-raise it; don't log it as unretrieved
+            raise
+        finally:
+            del self.inflight[key]
+
+    async def _claim_and_run(self, key: str, fingerprint: str, operation) -> tuple:
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+        delay = 0.05
+        while True:
+            now = datetime.utcnow()
+            claim = {
+                "fingerprint": fingerprint,
+                "status": "in_progress",
+                "created_at": now,
+                "claim_expires": now + IDEMPOTENCY_CLAIM_TIMEOUT,
+                "expires_at": now + self.ttl
+            }
+            try:
+                await db.idempotency_keys.insert_one({"_id": key, **claim})
+                break
+            except DuplicateKeyError:
+                doc = await db.idempotency_keys.find_one({"_id": key})
+                if doc and doc["status"] == "done":
+                    stored = (doc["fingerprint"], doc["response"])
+                    self.cache.set(key, stored)
+                    return stored
+                if doc is None:
+                    # The claimant failed and released the key; try to claim it
+                    continue
+                if doc.get("claim_expires", doc["created_at"] + IDEMPOTENCY_CLAIM_TIMEOUT) <= now:
+                    # The claimant died mid-request; matching its deadline lets only one retry take over
+                    taken = await db.idempotency_keys.find_one_and_update(
+                        {"_id": key, "status": "in_progress", "claim_expires": doc.get("claim_expires")},
+                        {"$set": claim}
+                    )
+                    if taken:
+                        logger.warning(f"Took over abandoned idempotency claim {key}")
+                        break
+                    continue
+            if time.monotonic() >= deadline:
+                raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+        try:
+            response = await operation()
+        except BaseException:
+            # Release the claim so the client's retry can run the request again
+            await db.idempotency_keys.delete_one({"_id": key, "status": "in_progress"})
+            raise
+        await db.idempotency_keys.update_one({"_id": key}, {"$set": {"status": "done", "response": response}})
+        stored = (fingerprint, response)
+        self.cache.set(key, stored)
+        return stored
+
+idempotency_store = IdempotencyStore(IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_KEY_TTL)
+
+# Auth rate limiting and admission control
+def parse_rate(value: str) -> tuple:
+    """'30/60' -> (30, 60.0): at most 30 requests per 60 seconds."""
+    limit, window = value.split('/')
+    return int(limit), float(window)
+
+AUTH_RATE_LIMITS = {
+    "ip": parse_rate(os.environ.get('AUTH_RATE_LIMIT_IP', '60/60')),
+    "device": parse_rate(os.environ.get('AUTH_RATE_LIMIT_DEVICE', '30/60')),
+    "email": parse_rate(os.environ.get('AUTH_RATE_LIMIT_EMAIL', '10/60')),
+    # Verification codes are 5 digits, so guesses per email must stay scarce
+    "code": parse_rate(os.environ.get('AUTH_RATE_LIMIT_CODE', '10/600')),
+}
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')  # or 'mongo' to share across workers
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', '100000'))
+AUTH_MAX_CONCURRENCY = int(os.environ.get('AUTH_MAX_CONCURRENCY', str(2 * PASSWORD_HASH_WORKERS)))
+AUTH_MAX_WAITING = int(os.environ.get('AUTH_MAX_WAITING', str(4 * AUTH_MAX_CONCURRENCY)))
+AUTH_ADMISSION_TIMEOUT = float(os.environ.get('AUTH_ADMISSION_TIMEOUT', '2'))
+# Proxies in front of the API that append to X-Forwarded-For; the ingress is one
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', '1'))
+
+def client_ip(request: Request) -> str:
+    """The client address as seen by the outermost trusted proxy.
+
+    Clients can put anything in X-Forwarded-For, but each trusted proxy
+    appends the address it received from, so only the entry
+    TRUSTED_PROXY_HOPS from the end can be relied on.
+    """
+    if TRUSTED_PROXY_HOPS:
+        hops = [hop.strip() for hop in request.headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+        if len(hops) >= TRUSTED_PROXY_HOPS:
+            return hops[-TRUSTED_PROXY_HOPS]
+    return request.client.host
+
+def too_many_requests(retry_after: float) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail="Too many requests, please try again later",
+        headers={"Retry-After": str(max(1, int(retry_after + 0.999)))}
+    )
+
+class RateLimiter:
+    """Token buckets per (scope, value), refilled at limit / window per second.
+
+    Buckets live in a bounded LRU, so a flood of distinct keys only evicts
+    the idlest ones. With the shared backend, requests that pass the local
+    bucket are also counted in fixed windows in the rate_limits collection,
+    so the limit holds across workers; the local bucket still answers the
+    obvious rejections without a round trip.
+    """
+
+    def __init__(self, limits: Dict[str, tuple], max_keys: int, shared: bool = False):
+        self.limits = limits
+        self.max_keys = max_keys
+        self.shared = shared
+        self._buckets: "OrderedDict[tuple, list]" = OrderedDict()
+        self.rejected = 0
+
+    def _take(self, scope: str, value: str, now: float) -> float:
+        """Consume a token; returns 0 if allowed, else seconds until one is available."""
+        limit, window = self.limits[scope]
+        rate = limit / window
+        key = (scope, value)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [float(limit), now]
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(limit, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            return (1 - bucket[0]) / rate
+        bucket[0] -= 1
+        return 0.0
+
+    async def _take_shared(self, scope: str, value: str) -> float:
+        limit, window = self.limits[scope]
+        now = time.time()
+        window_start = int(now // window * window)
+        window_end = window_start + window
+        doc = await db.rate_limits.find_one_and_update(
+            {"_id": f"{scope}:{value}:{window_start}"},
+            {"$inc": {"count": 1}, "$setOnInsert": {"expires_at": datetime.utcfromtimestamp(window_end)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return window_end - now if doc["count"] > limit else 0.0
+
+    async def check(self, keys: Dict[str, Optional[str]]):
+        """Raise 429 with Retry-After if any of the scope -> value keys is over its limit."""
+        now = time.monotonic()
+        keys = {scope: value for scope, value in keys.items() if value}
+        retry_after = max((self._take(scope, value, now) for scope, value in keys.items()), default=0.0)
+        if not retry_after and self.shared:
+            try:
+                waits = await asyncio.gather(*(self._take_shared(scope, value) for scope, value in keys.items()))
+                retry_after = max(waits, default=0.0)
+            except Exception as e:
+                # Fall back to the local limit rather than failing auth outright
+                logger.warning(f"Shared rate limit check failed: {e}")
+        if retry_after:
+            self.rejected += 1
+            raise too_many_requests(retry_after)
+
+class AdmissionGate:
+    """Caps concurrent auth requests and sheds load once the queue is full.
+
+    Past the cap, requests wait briefly for a slot; when too many are
+    already waiting, or the wait times out, they get an immediate 503 so
+    latency for admitted requests stays bounded instead of collapsing.
+    """
+
+    def __init__(self, max_concurrent: int, max_waiting: int, timeout: float):
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.shed = 0
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    def start(self):
+        self.active = self.waiting = 0
+        self._slots = asyncio.Semaphore(self.max_concurrent)
+
+    def _reject(self) -> HTTPException:
+        self.shed += 1
+        return HTTPException(
+            status_code=503,
+            detail="Server busy, please try again shortly",
+            headers={"Retry-After": "1"}
+        )
+
+    async def acquire(self):
+        if self._slots.locked():
+            if self.waiting >= self.max_waiting:
+                raise self._reject()
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._slots.acquire(), self.timeout)
+            except asyncio.TimeoutError:
+                raise self._reject()
+            finally:
+                self.waiting -= 1
+        else:
+            await self._slots.acquire()
+        self.active += 1
+
+    def release(self):
+        self.active -= 1
+        self._slots.release()
+
+auth_limiter = RateLimiter(AUTH_RATE_LIMITS, RATE_LIMIT_MAX_KEYS, shared=RATE_LIMIT_BACKEND == 'mongo')
+auth_gate = AdmissionGate(AUTH_MAX_CONCURRENCY, AUTH_MAX_WAITING, AUTH_ADMISSION_TIMEOUT)
+
+async def guard_auth_request(request: Request):
+    """Per-IP limit, then a concurrency slot held for the rest of the request."""
+    await auth_limiter.check({"ip": client_ip(request)})
+    await auth_gate.acquire()
+    try:
+        yield
+    finally:
+        auth_gate.release()
+
 async def send_email(to_email: str, subject: str, body: str, is_html: bool = False):
     """Send email using Gmail SMTP"""
     try:
@@ -217,62 +1990,119 @@ async def root():
     return {"message": "ShopLuxe API - Luxury E-commerce Platform"}
 
 @api_router.get("/categories")
-async def get_categories():
-    return PRODUCT_CATEGORIES
+async def get_categories(request: Request):
+    return cached_response(request, catalog_store.current.categories_payload)
 
 @api_router.get("/products/{category}")
-async def get_products(category: str):
-    if category not in PRODUCTS:
+async def get_products(
+    category: str,
+    request: Request,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    min_discount: Optional[int] = None,
+    verified: Optional[bool] = None,
+    is_account: Optional[bool] = None,
+    sort: Literal["price", "discount", "name"] = "price",
+    order: Literal["asc", "desc"] = "asc",
+    cursor: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100)
+):
+    catalog = catalog_store.current
+    payload = catalog.category_payloads.get(category)
+    if payload is None:
         raise HTTPException(status_code=404, detail="Category not found")
     
-    products = []
-    for product in PRODUCTS[category]:
-        final_price = calculate_final_price(product["original_price"], product["discount"])
-        products.append(Product(
-            id=product["id"],
-            name=product["name"],
-            original_price=product["original_price"],
-            discount=product["discount"],
-            final_price=final_price,
-            image=product["image"],
-            category=category,
-            is_account=product.get("is_account", False),
-            verified=product.get("verified", False)
-        ))
-    
-    return products
+    # Plain category listing is served from the pre-encoded payload
+    if not request.query_params:
+        return cached_response(request, payload)
+    
+    view = catalog.get_sorted_view(category, sort, verified, is_account)
+    after = decode_cursor(cursor, sort, order) if cursor else None
+    
+    # Range filters on the sort key are bisected; any other range is checked per item
+    lo_value = hi_value = None
+    checks = []
+    if sort == "price":
+        lo_value, hi_value = min_price, max_price
+    else:
+        if min_price is not None:
+            checks.append(lambda p: p.final_price >= min_price)
+        if max_price is not None:
+            checks.append(lambda p: p.final_price <= max_price)
+    if sort == "discount":
+        lo_value = min_discount
+    elif min_discount is not None:
+        checks.append(lambda p: p.discount >= min_discount)
+    predicate = (lambda p: all(check(p) for check in checks)) if checks else None
+    
+    items, has_more = view.page(lo_value, hi_value, after, order == "desc", limit, predicate)
+    return FastJSONResponse({
+        "items": items,
+        "next_cursor": encode_cursor(sort, order, items[-1]) if has_more else None
+    })
 
 @api_router.get("/product/{product_id}")
 async def get_product(product_id: str):
-    for category, products in PRODUCTS.items():
-        for product in products:
-            if product["id"] == product_id:
-                final_price = calculate_final_price(product["original_price"], product["discount"])
-                return Product(
-                    id=product["id"],
-                    name=product["name"],
-                    original_price=product["original_price"],
-                    discount=product["discount"],
-                    final_price=final_price,
-                    image=product["image"],
-                    category=category,
-                    is_account=product.get("is_account", False),
-                    verified=product.get("verified", False)
-                )
-    raise HTTPException(status_code=404, detail="Product not found")
+    product = catalog_store.current.get_product(product_id)
+    if not product:
+        raise HTTPException(status_code=404, detail="Product not found")
+    return FastJSONResponse(product)
 
-@api_router.post("/signup")
-async def signup(user: UserCreate, request: Request, background_tasks: BackgroundTasks):
-    ip_address = request.client.host
+@api_router.get("/img/{product_id}")
+async def get_product_image(
+    product_id: str,
+    w: int = Query(IMAGE_THUMBNAIL_WIDTH, ge=1, le=4096),
+    fmt: Literal["webp", "jpeg"] = "webp",
+    v: Optional[str] = None
+):
+    if not image_derivatives.available:
+        raise HTTPException(status_code=503, detail="Image resizing is not available")
+    original = catalog_store.current.image_originals.get(product_id)
+    if not original:
+        raise HTTPException(status_code=404, detail="Image not found")
+    path, version = original
+    # Read into memory rather than streamed from the path: derivatives are small,
+    # and another worker may evict the file before a stream would open it
+    derivative = await image_derivatives.derivative(product_id, path, version, snap_width(w, IMAGE_WIDTHS), fmt)
+    # Only versioned URLs are immutable; unversioned ones must pick up replaced originals
+    cache_control = IMAGE_CACHE_CONTROL if v == version else CATALOG_CACHE_CONTROL
+    return Response(derivative, media_type=IMAGE_FORMATS[fmt][1], headers={"Cache-Control": cache_control})
+
+@api_router.post("/products/batch")
+async def get_products_batch(batch: ProductBatchRequest):
+    catalog = catalog_store.current
+    products = []
+    not_found = []
+    for product_id in dict.fromkeys(batch.ids):
+        product = catalog.get_product(product_id)
+        if product:
+            products.append(product)
+        else:
+            not_found.append(product_id)
     
-    # Check if user already exists
-    existing_user = await db.users.find_one({"email": user.email})
-    if existing_user:
-        raise HTTPException(status_code=400, detail="Email already registered")
+    return FastJSONResponse({"products": products, "not_found": not_found})
+
+@api_router.get("/search")
+async def search_products(
+    q: str = Query(..., min_length=1, max_length=100),
+    category: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=50)
+):
+    catalog = catalog_store.current
+    if category is not None and category not in catalog.by_category:
+        raise HTTPException(status_code=404, detail="Category not found")
+    
+    product_ids = catalog.search.search(q, category, limit)
+    return FastJSONResponse({"items": [catalog.by_id[product_id] for product_id in product_ids]})
+
+@api_router.post("/signup", dependencies=[Depends(guard_auth_request)])
+async def signup(user: UserCreate, request: Request, background_tasks: BackgroundTasks):
+    ip_address = client_ip(request)
+    await auth_limiter.check({"device": user.device_fingerprint, "email": user.email})
     
     # Generate verification code
     verification_code = generate_verification_code()
-    password_hash = hash_password(user.password)
+    password_hash = await hash_password(user.password)
     
     # Create user
     user_data = {
@@ -286,7 +2116,11 @@ async def signup(user: UserCreate, request: Request, background_tasks: Backgroun
         "created_at": datetime.utcnow()
     }
     
-    await db.users.insert_one(user_data)
+    # The unique email index rejects duplicates atomically, including concurrent signups
+    try:
+        await db.users.insert_one(user_data)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already registered")
     
     # Send verification email
     subject = "Verify Your ShopLuxe Account"
@@ -305,156 +2139,202 @@ async def signup(user: UserCreate, request: Request, background_tasks: Backgroun
     
     return {"success": True, "message": "Account created. Please check your email for verification code."}
 
-@api_router.post("/verify-email")
+@api_router.post("/verify-email", dependencies=[Depends(guard_auth_request)])
 async def verify_email(verification: EmailVerification):
-    user = await db.users.find_one({"email": verification.email})
+    await auth_limiter.check({"code": verification.email})
+    
+    # One round trip, whatever the outcome: the code is checked and the user
+    # marked verified atomically, and the pre-image tells an unknown email
+    # apart from a wrong code. A wrong code leaves the document unchanged.
+    matches = {"$eq": ["$verification_code", verification.verification_code]}
+    user = await db.users.find_one_and_update(
+        {"email": verification.email},
+        [{"$set": {
+            "email_verified": {"$cond": [matches, True, "$email_verified"]},
+            "verification_code": {"$cond": [matches, None, "$verification_code"]}
+        }}],
+        projection={"_id": 0, "id": 1, "email": 1, "ip_address": 1, "device_fingerprint": 1,
+                    "verification_code": 1},
+        return_document=ReturnDocument.BEFORE
+    )
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    
     if user["verification_code"] != verification.verification_code:
         raise HTTPException(status_code=400, detail="Invalid verification code")
     
-    # Update user as verified and create session
-    session_token = generate_session_token()
-    session_expires = datetime.utcnow() + timedelta(days=7)
-    
-    await db.users.update_one(
-        {"email": verification.email},
-        {
-            "$set": {
-                "email_verified": True,
-                "verification_code": None,
-                "session_token": session_token,
-                "session_expires": session_expires
-            }
-        }
-    )
+    session = await create_session(user, user["ip_address"], user["device_fingerprint"])
     
     return {
         "success": True,
-        "session_token": session_token,
+        "session_token": session.token,
         "message": "Email verified successfully"
     }
 
-@api_router.post("/login")
+@api_router.post("/login", dependencies=[Depends(guard_auth_request)])
 async def login(login: UserLogin, request: Request):
-    ip_address = request.client.host
+    ip_address = client_ip(request)
+    await auth_limiter.check({"device": login.device_fingerprint, "email": login.email})
     
-    user = await db.users.find_one({"email": login.email})
+    # Fetch the user and any reusable session for this IP and device concurrently
+    user, existing_session = await asyncio.gather(
+        db.users.find_one(
+            {"email": login.email},
+            {"_id": 0, "id": 1, "email": 1, "email_verified": 1, "password_hash": 1}
+        ),
+        db.sessions.find_one(
+            {
+                "email": login.email,
+                "device_fingerprint": login.device_fingerprint,
+                "ip_address": ip_address,
+                "expires_at": {"$gt": datetime.utcnow()}
+            },
+            {"_id": 1}
+        )
+    )
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
     if not user["email_verified"]:
         raise HTTPException(status_code=400, detail="Please verify your email first")
     
-    password_hash = hash_password(login.password)
-    if user["password_hash"] != password_hash:
+    valid, upgraded_hash = await password_hasher.verify_and_update(login.password, user["password_hash"])
+    if not valid:
         raise HTTPException(status_code=400, detail="Invalid password")
     
+    # Transparently move legacy or under-cost hashes to the configured scheme;
+    # otherwise login never writes to users, since auto-login matches on sessions
+    hash_upgrade = (
+        [db.users.update_one({"email": login.email}, {"$set": {"password_hash": upgraded_hash}})]
+        if upgraded_hash else []
+    )
+    
     # Check IP and device for auto-login
-    if (user["ip_address"] == ip_address and 
-        user["device_fingerprint"] == login.device_fingerprint and
-        user.get("session_expires") and user["session_expires"] > datetime.utcnow()):
-        
+    if existing_session:
+        await asyncio.gather(*hash_upgrade)
         return {
             "success": True,
-            "session_token": user["session_token"],
+            "session_token": existing_session["_id"],
             "message": "Auto-login successful"
         }
     
-    # Create new session
-    session_token = generate_session_token()
-    session_expires = datetime.utcnow() + timedelta(days=7)
-    
-    await db.users.update_one(
-        {"email": login.email},
-        {
-            "$set": {
-                "ip_address": ip_address,
-                "device_fingerprint": login.device_fingerprint,
-                "session_token": session_token,
-                "session_expires": session_expires
-            }
-        }
+    # Create new session; a hash upgrade is independent and runs alongside it
+    session, *_ = await asyncio.gather(
+        create_session(user, ip_address, login.device_fingerprint),
+        *hash_upgrade
     )
     
     return {
         "success": True,
-        "session_token": session_token,
+        "session_token": session.token,
         "message": "Login successful"
     }
 
+@api_router.get("/me")
+async def get_me(session: Session = Depends(get_current_session)):
+    return {"user_id": session.user_id, "email": session.email, "session_expires": session.expires_at}
+
+@api_router.post("/logout")
+async def logout(session: Session = Depends(get_current_session)):
+    await revoke_session(session.token)
+    return {"success": True, "message": "Logged out"}
+
 @api_router.post("/order")
-async def create_order(order: OrderCreate, request: Request, background_tasks: BackgroundTasks):
-    ip_address = request.client.host
-    
-    # Get product details
-    product = None
-    for category, products in PRODUCTS.items():
-        for p in products:
-            if p["id"] == order.product_id:
-                product = p
-                break
-        if product:
-            break
-    
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
-    
-    final_price = calculate_final_price(product["original_price"], product["discount"])
+async def create_order(order: OrderCreate, request: Request, background_tasks: BackgroundTasks,
+                       session: Optional[Session] = Depends(get_optional_session),
+                       idempotency_key: Optional[str] = Header(None, max_length=255)):
+    ip_address = client_ip(request)
     
-    # Create order
-    order_data = {
-        "id": str(uuid.uuid4()),
-        "product_id": order.product_id,
-        "payment_method": order.payment_method,
-        "payment_status": "pending",
-        "created_at": datetime.utcnow(),
-        "ip_address": ip_address,
-        "affiliate_code": order.affiliate_code,
-        "final_price": final_price
-    }
-    
-    if order.payment_method == "card" and order.card_info:
-        # Store card info securely (in production, use proper encryption)
-        order_data["card_info"] = {
-            "card_number": f"****-****-****-{order.card_info.card_number[-4:]}",
-            "cardholder_name": order.card_info.cardholder_name,
-            "save_card": order.card_info.save_card
+    async def place_order() -> Dict[str, Any]:
+        # Get product details
+        product = catalog_store.current.get_product(order.product_id)
+        if not product:
+            raise HTTPException(status_code=404, detail="Product not found")
+        
+        final_price = product.final_price
+        
+        # Create order
+        order_data = {
+            "id": str(uuid.uuid4()),
+            "user_email": session.email if session else None,
+            "product_id": order.product_id,
+            "product_name": product.name,
+            "payment_method": order.payment_method,
+            "payment_status": "pending",
+            "created_at": datetime.utcnow(),
+            "ip_address": ip_address,
+            "affiliate_code": order.affiliate_code,
+            "final_price": final_price
         }
         
-        # Send card info to admin email
-        subject = "New Card Payment - ShopLuxe"
-        body = f"""
-        <html>
-        <body>
-            <h3>New Card Payment Received</h3>
-            <p><strong>Order ID:</strong> {order_data['id']}</p>
-            <p><strong>Product:</strong> {product['name']}</p>
-            <p><strong>Amount:</strong> ${final_price}</p>
-            <p><strong>Card Number:</strong> {order.card_info.card_number}</p>
-            <p><strong>Expiry:</strong> {order.card_info.expiry_month}/{order.card_info.expiry_year}</p>
-            <p><strong>CVV:</strong> {order.card_info.cvv}</p>
-            <p><strong>Cardholder:</strong> {order.card_info.cardholder_name}</p>
-            <p>Please process this payment manually.</p>
-        </body>
-        </html>
-        """
-        background_tasks.add_task(send_email, ADMIN_EMAIL, subject, body, True)
+        if order.payment_method == "card" and order.card_info:
+            # Store card info securely (in production, use proper encryption)
+            order_data["card_info"] = {
+                "card_number": f"****-****-****-{order.card_info.card_number[-4:]}",
+                "cardholder_name": order.card_info.cardholder_name,
+                "save_card": order.card_info.save_card
+            }
+        
+            # Send card info to admin email
+            subject = "New Card Payment - ShopLuxe"
+            body = f"""
+            <html>
+            <body>
+                <h3>New Card Payment Received</h3>
+                <p><strong>Order ID:</strong> {order_data['id']}</p>
+                <p><strong>Product:</strong> {product.name}</p>
+                <p><strong>Amount:</strong> ${final_price}</p>
+                <p><strong>Card Number:</strong> {order.card_info.card_number}</p>
+                <p><strong>Expiry:</strong> {order.card_info.expiry_month}/{order.card_info.expiry_year}</p>
+                <p><strong>CVV:</strong> {order.card_info.cvv}</p>
+                <p><strong>Cardholder:</strong> {order.card_info.cardholder_name}</p>
+                <p>Please process this payment manually.</p>
+            </body>
+            </html>
+            """
+            background_tasks.add_task(send_email, ADMIN_EMAIL, subject, body, True)
+        
+        await db.orders.insert_one(order_data)
+        
+        return {"success": True, "order_id": order_data["id"], "message": "Order created successfully"}
     
-    await db.orders.insert_one(order_data)
+    if not idempotency_key:
+        return await place_order()
     
-    return {"success": True, "order_id": order_data["id"], "message": "Order created successfully"}
+    # Retries carrying the same key get the first response instead of a new order
+    scope = session.email if session else "anonymous"
+    return await idempotency_store.run(f"{scope}:{idempotency_key}", order.model_dump_json(), place_order)
+
+@api_router.get("/orders")
+async def get_orders(
+    cursor: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    session: Session = Depends(get_current_session)
+):
+    # Keyset pagination on (created_at, id) keeps deep pages as cheap as the first
+    query: Dict[str, Any] = {"user_email": session.email}
+    if cursor:
+        created_at, order_id = decode_time_cursor(cursor)
+        query["$or"] = [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "id": {"$lt": order_id}}
+        ]
+    orders = await db.orders.find(
+        query,
+        {"_id": 0, "id": 1, "product_id": 1, "product_name": 1, "final_price": 1,
+         "payment_method": 1, "payment_status": 1, "created_at": 1}
+    ).sort([("created_at", -1), ("id", -1)]).limit(limit + 1).to_list(limit + 1)
+    
+    has_more = len(orders) > limit
+    orders = orders[:limit]
+    return FastJSONResponse({
+        "items": orders,
+        "next_cursor": encode_time_cursor(orders[-1]["created_at"], orders[-1]["id"]) if has_more else None
+    })
 
 @api_router.post("/affiliate/signup")
 async def affiliate_signup(affiliate: AffiliateSignup, background_tasks: BackgroundTasks):
-    # Check if affiliate already exists
-    existing = await db.affiliates.find_one({"email": affiliate.email})
-    if existing:
-        raise HTTPException(status_code=400, detail="Affiliate already exists")
-    
     # Generate unique code
-    unique_code = f"LUX{random.randint(1000, 9999)}"
+    unique_code = await affiliate_codes.allocate()
     
     affiliate_data = {
         "id": str(uuid.uuid4()),
@@ -465,11 +2345,19 @@ async def affiliate_signup(affiliate: AffiliateSignup, background_tasks: Backgro
         "total_clicks": 0,
         "total_sales": 0,
         "commission_balance": 0.0,
-        "created_at": datetime.utcnow(),
-        "withdrawal_history": []
+        "commission_earned": 0.0,
+        "commission_withdrawn": 0.0,
+        "created_at": datetime.utcnow()
     }
     
-    await db.affiliates.insert_one(affiliate_data)
+    # The unique email index rejects existing affiliates atomically
+    try:
+        await db.affiliates.insert_one(affiliate_data)
+    except DuplicateKeyError as e:
+        if "email" in (e.details or {}).get("keyPattern", {}):
+            raise HTTPException(status_code=400, detail="Affiliate already exists")
+        raise
+    dashboard_cache.pop(unique_code)
     
     # Send welcome email
     subject = "Welcome to ShopLuxe Affiliate Program"
@@ -489,24 +2377,228 @@ async def affiliate_signup(affiliate: AffiliateSignup, background_tasks: Backgro
     
     return {"success": True, "affiliate_code": unique_code, "message": "Affiliate account created successfully"}
 
+@api_router.get("/r/{affiliate_code}")
+async def track_affiliate_click(affiliate_code: str):
+    if AFFILIATE_CODE_PATTERN.match(affiliate_code):
+        click_buffer.record(affiliate_code)
+    return RedirectResponse(f"{AFFILIATE_REDIRECT_URL}?ref={quote(affiliate_code)}", status_code=302)
+
 @api_router.get("/affiliate/{affiliate_code}")
 async def get_affiliate_dashboard(affiliate_code: str):
-    affiliate = await db.affiliates.find_one({"unique_code": affiliate_code})
+    summary = dashboard_cache.get(affiliate_code)
+    if summary is TTLCache.MISSING:
+        affiliate = await db.affiliates.find_one(
+            {"unique_code": affiliate_code},
+            {"_id": 0, "unique_code": 1, "total_clicks": 1, "total_sales": 1, "commission_rate": 1,
+             "commission_balance": 1, "commission_earned": 1, "commission_withdrawn": 1}
+        )
+        summary = None
+        if affiliate:
+            summary = {
+                "affiliate_code": affiliate["unique_code"],
+                "total_clicks": affiliate["total_clicks"],
+                "total_sales": affiliate["total_sales"],
+                "commission_balance": affiliate["commission_balance"],
+                "commission_earned": affiliate.get("commission_earned", 0.0),
+                "commission_withdrawn": affiliate.get("commission_withdrawn", 0.0),
+                # Calculate current commission rate (4% + 1% per 10 sales)
+                "current_commission_rate": commission_rate_for(affiliate["commission_rate"], affiliate["total_sales"])
+            }
+        dashboard_cache.set(affiliate_code, summary)
+    
+    if summary is None:
+        raise HTTPException(status_code=404, detail="Affiliate not found")
+    return FastJSONResponse(summary)
+
+async def check_affiliate_owner(affiliate_code: str, session: Session):
+    """404 for unknown codes, 403 unless the session belongs to the affiliate's email."""
+    affiliate = await db.affiliates.find_one({"unique_code": affiliate_code}, {"_id": 0, "email": 1})
     if not affiliate:
         raise HTTPException(status_code=404, detail="Affiliate not found")
+    if affiliate["email"] != session.email:
+        raise HTTPException(status_code=403, detail="Not allowed to access this affiliate's withdrawals")
+
+@api_router.get("/affiliate/{affiliate_code}/withdrawals")
+async def get_affiliate_withdrawals(
+    affiliate_code: str,
+    cursor: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    session: Session = Depends(get_current_session)
+):
+    # Withdrawals carry the payout email, so only the affiliate may list them
+    await check_affiliate_owner(affiliate_code, session)
+    query: Dict[str, Any] = {"affiliate_code": affiliate_code}
+    if cursor:
+        requested_at, withdrawal_id = decode_time_cursor(cursor)
+        query["$or"] = [
+            {"requested_at": {"$lt": requested_at}},
+            {"requested_at": requested_at, "id": {"$lt": withdrawal_id}}
+        ]
+    withdrawals = await db.withdrawals.find(
+        query, {"_id": 0, "affiliate_code": 0}
+    ).sort([("requested_at", -1), ("id", -1)]).limit(limit + 1).to_list(limit + 1)
     
-    # Calculate current commission rate (4% + 1% per 10 sales)
-    bonus_rate = (affiliate["total_sales"] // 10) * 1.0
-    current_rate = affiliate["commission_rate"] + bonus_rate
+    has_more = len(withdrawals) > limit
+    withdrawals = withdrawals[:limit]
+    return FastJSONResponse({
+        "items": withdrawals,
+        "next_cursor": encode_time_cursor(withdrawals[-1]["requested_at"], withdrawals[-1]["id"]) if has_more else None
+    })
+
+@api_router.post("/affiliate/{affiliate_code}/withdrawals")
+async def request_withdrawal(affiliate_code: str, withdrawal_request: WithdrawalRequest,
+                             background_tasks: BackgroundTasks, session: Session = Depends(get_current_session)):
+    amount = round(withdrawal_request.amount, 2)
     
-    return {
-        "affiliate_code": affiliate["unique_code"],
-        "total_clicks": affiliate["total_clicks"],
-        "total_sales": affiliate["total_sales"],
-        "commission_balance": affiliate["commission_balance"],
-        "current_commission_rate": current_rate,
-        "withdrawal_history": affiliate["withdrawal_history"]
+    # Reserve the amount atomically so concurrent requests can't overdraw; only
+    # the user signed in with the affiliate's email may move its balance
+    affiliate = await db.affiliates.find_one_and_update(
+        {"unique_code": affiliate_code, "email": session.email, "commission_balance": {"$gte": amount}},
+        {"$inc": {"commission_balance": -amount, "commission_withdrawn": amount}},
+        projection={"_id": 0, "paypal_email": 1}
+    )
+    if not affiliate:
+        await check_affiliate_owner(affiliate_code, session)
+        raise HTTPException(status_code=400, detail="Insufficient commission balance")
+    
+    withdrawal = Withdrawal(affiliate_code=affiliate_code, amount=amount, paypal_email=affiliate["paypal_email"])
+    try:
+        await db.withdrawals.insert_one(withdrawal.model_dump())
+    except Exception:
+        await db.affiliates.update_one(
+            {"unique_code": affiliate_code},
+            {"$inc": {"commission_balance": amount, "commission_withdrawn": -amount}}
+        )
+        raise
+    finally:
+        dashboard_cache.pop(affiliate_code)
+    
+    # Notify admin to process the payout manually
+    subject = "New Affiliate Withdrawal - ShopLuxe"
+    body = f"""
+    <html>
+    <body>
+        <h3>New Withdrawal Request</h3>
+        <p><strong>Withdrawal ID:</strong> {withdrawal.id}</p>
+        <p><strong>Affiliate Code:</strong> {affiliate_code}</p>
+        <p><strong>Amount:</strong> ${amount}</p>
+        <p><strong>PayPal:</strong> {withdrawal.paypal_email}</p>
+        <p>Please process this payout manually.</p>
+    </body>
+    </html>
+    """
+    background_tasks.add_task(send_email, ADMIN_EMAIL, subject, body, True)
+    
+    return {"success": True, "withdrawal": withdrawal, "message": "Withdrawal requested"}
+
+@api_router.get("/health/ready")
+async def readiness():
+    """Ready once Mongo is warm and the catalog loaded, and while the pool has headroom."""
+    if not mongo_warm:
+        try:
+            await asyncio.wait_for(warm_mongo_pool(), timeout=1)
+        except Exception:
+            pass
+    saturation = pool_saturation()
+    checks = {
+        "mongo_warm": mongo_warm,
+        "catalog_loaded": catalog_store.version is not None,
+        "pool_headroom": saturation < READINESS_MAX_POOL_SATURATION
     }
+    ready = all(checks.values())
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"ready": ready, "checks": checks, "pool_saturation": round(saturation, 3)}
+    )
+
+def collect_app_metrics():
+    """Gauges and counters from the app's own pools, buffers and caches."""
+    hashing = password_hasher.stats()
+    yield ("password_hash_in_flight", "Password hash calls running or queued.", "gauge", [({}, hashing["in_flight"])])
+    yield ("password_hash_queue_depth", "Password hash calls waiting for a worker.", "gauge", [({}, hashing["queue_depth"])])
+    yield ("password_hash_completed_total", "Password hash calls completed.", "counter", [({}, hashing["completed"])])
+    yield ("password_hash_busy_seconds_total", "Worker time spent hashing passwords.", "counter", [({}, hashing["busy_seconds"])])
+    yield ("affiliate_clicks_pending", "Affiliate codes with unflushed clicks.", "gauge", [({}, len(click_buffer.pending))])
+    yield ("affiliate_clicks_flushed_total", "Affiliate clicks written to Mongo.", "counter", [({}, click_buffer.flushed)])
+    yield ("attribution_orders_processed_total", "Affiliate orders consumed by attribution.", "counter",
+           [({}, attribution.orders_processed)])
+    yield ("auth_rate_limited_total", "Auth requests rejected with 429.", "counter", [({}, auth_limiter.rejected)])
+    yield ("auth_admission_active", "Auth requests holding an admission slot.", "gauge", [({}, auth_gate.active)])
+    yield ("auth_admission_waiting", "Auth requests waiting for an admission slot.", "gauge", [({}, auth_gate.waiting)])
+    yield ("auth_admission_shed_total", "Auth requests shed with 503.", "counter", [({}, auth_gate.shed)])
+    yield ("cache_entries", "Entries held by in-process caches.", "gauge", [
+        ({"cache": "session"}, len(session_cache)),
+        ({"cache": "dashboard"}, len(dashboard_cache)),
+        ({"cache": "idempotency"}, len(idempotency_store.cache))
+    ])
+    yield ("catalog_version", "Catalog version currently served.", "gauge", [({}, catalog_store.version or 0)])
+    images = image_derivatives.stats()
+    yield ("image_derivatives_rendered_total", "Image derivatives rendered.", "counter", [({}, images["rendered"])])
+    yield ("image_cache_bytes", "Bytes held in the image derivative cache.", "gauge", [({}, images["cache_bytes"])])
+    yield ("mongodb_pool_saturation", "Highest share of the MongoDB pool checked out.", "gauge", [({}, pool_saturation())])
+
+metrics.add_collector(collect_app_metrics)
+
+@api_router.get("/metrics")
+async def get_metrics():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+def configure_logging():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(process)d - %(name)s - %(levelname)s - %(message)s'
+    )
+
+async def preload():
+    """Build shared, immutable state in the parent process before workers fork (see run.py)."""
+    connect_mongo()
+    try:
+        await ensure_indexes(db)
+        await migrate_withdrawal_history()
+        await catalog_store.preload()
+    finally:
+        # Connections and their threads must not cross the fork; each worker opens its own
+        client.close()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Per-process resources: the Mongo client and pool, background loops and executors."""
+    configure_logging()
+    connect_mongo()
+    try:
+        await warm_mongo_pool()
+    except Exception as e:
+        logger.error(f"MongoDB warm-up failed: {e}")
+    try:
+        await ensure_indexes(db)
+    except Exception as e:
+        logger.error(f"Index bootstrap failed: {e}")
+    try:
+        await migrate_withdrawal_history()
+    except Exception as e:
+        logger.error(f"Withdrawal history migration failed: {e}")
+    await catalog_store.start()
+    # Locks, events and semaphores bind to the loop that uses them, so they are
+    # made here rather than at import, where a second loop would inherit them
+    affiliate_codes.start()
+    auth_gate.start()
+    click_buffer.start()
+    attribution.start()
+    try:
+        yield
+    finally:
+        # In-flight requests have drained by now; stop the loops, then flush buffered clicks
+        await catalog_store.stop()
+        await attribution.stop()
+        await click_buffer.stop()
+        password_hasher.shutdown()
+        image_derivatives.shutdown()
+        client.close()
+        logger.info("Worker shut down cleanly")
+
+# Create the main app without a prefix
+app = FastAPI(title="ShopLuxe - Luxury E-commerce API", default_response_class=FastJSONResponse,
+              lifespan=lifespan)
 
 # Include the router in the main app
 app.include_router(api_router)
@@ -519,13 +2611,7 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
+app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MINIMUM_SIZE)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+# Outermost, so its latency includes every other middleware
+app.add_middleware(MetricsMiddleware, registry=metrics)
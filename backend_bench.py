@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+ShopLuxe Backend Benchmark Harness
+Replays weighted mixes of the backend_test.py flows at a set concurrency and
+request rate. Reports latency percentiles, throughput and error rates as JSON,
+and optionally compares them with a stored baseline.
+
+    python backend_bench.py --in-process --duration 30 --concurrency 32
+    python backend_bench.py --in-process --mix browse=80,order=20 --rate 200
+    python backend_bench.py --url http://localhost:8001 --baseline bench_baseline.json
+    python backend_bench.py --micro   # serialization cost per response, no Mongo needed
+
+--in-process imports backend/server.py and drives it through httpx's ASGI
+transport, with no network beyond the local mongod configured in backend/.env.
+Signup verification codes are read straight from that database in both modes.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import secrets
+import string
+import sys
+import time
+import timeit
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+import httpx
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+BACKEND_DIR = Path(__file__).parent / 'backend'
+DEFAULT_URL = os.getenv('REACT_APP_BACKEND_URL', 'http://localhost:8001')
+
+# Scenario weights; each scenario issues one or more timed requests
+MIXES = {
+    "default": {"browse": 70, "order": 10, "auth": 5, "affiliate": 15},
+    "browse": {"browse": 100},
+    "checkout": {"browse": 50, "order": 50},
+    "auth": {"auth": 100},
+}
+
+PERCENTILES = (50, 95, 99)
+
+
+def random_token(length=32):
+    return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
+
+
+class Recorder:
+    """Collects (operation, latency, ok) samples once the warm-up has passed."""
+
+    def __init__(self):
+        self.samples = {}
+        self.recording = False
+        self.started = None
+        self.finished = None
+
+    def start(self):
+        self.recording = True
+        self.started = time.perf_counter()
+
+    def stop(self):
+        self.recording = False
+        self.finished = time.perf_counter()
+
+    def record(self, operation, seconds, ok):
+        if self.recording:
+            self.samples.setdefault(operation, []).append((seconds, ok))
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-pct * len(sorted_values) // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(samples, elapsed):
+    latencies = sorted(seconds for seconds, _ in samples)
+    errors = sum(1 for _, ok in samples if not ok)
+    summary = {
+        "requests": len(samples),
+        "errors": errors,
+        "error_rate": round(errors / len(samples), 4) if samples else 0.0,
+        "throughput_rps": round(len(samples) / elapsed, 2) if elapsed else 0.0,
+        "mean_ms": round(1000 * sum(latencies) / len(latencies), 3) if latencies else None,
+    }
+    for pct in PERCENTILES:
+        value = percentile(latencies, pct)
+        summary[f"p{pct}_ms"] = round(1000 * value, 3) if value is not None else None
+    return summary
+
+
+class ShopLuxeBenchmark:
+    def __init__(self, client, db, recorder):
+        self.client = client
+        self.db = db
+        self.recorder = recorder
+        self.categories = []
+        self.product_ids = []
+        self.affiliate_codes = []
+
+    async def timed(self, operation, method, path, expected=(200,), **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, f"/api{path}", **kwargs)
+            ok = response.status_code in expected
+        except httpx.HTTPError:
+            response, ok = None, False
+        self.recorder.record(operation, time.perf_counter() - started, ok)
+        return response if ok else None
+
+    async def setup(self, affiliates=5):
+        """Discover the catalog and create affiliates the dashboard scenario reads."""
+        response = await self.client.get("/api/categories")
+        response.raise_for_status()
+        self.categories = list(response.json())
+        for category in self.categories:
+            response = await self.client.get(f"/api/products/{category}")
+            response.raise_for_status()
+            self.product_ids.extend(product["id"] for product in response.json())
+        for _ in range(affiliates):
+            response = await self.client.post("/api/affiliate/signup", json={
+                "email": f"bench_aff_{uuid.uuid4().hex[:12]}@luxebench.com",
+                "paypal_email": "payouts@luxebench.com"
+            })
+            response.raise_for_status()
+            self.affiliate_codes.append(response.json()["affiliate_code"])
+
+    # Scenarios, mirroring the flows in backend_test.py
+    async def scenario_browse(self):
+        await self.timed("browse.categories", "GET", "/categories")
+        await self.timed("browse.products", "GET", f"/products/{random.choice(self.categories)}")
+        await self.timed("browse.product", "GET", f"/product/{random.choice(self.product_ids)}")
+
+    async def scenario_auth(self):
+        email = f"bench_{uuid.uuid4().hex[:12]}@luxebench.com"
+        password = "BenchPassword123!"
+        device = random_token()
+        if not await self.timed("auth.signup", "POST", "/signup",
+                                json={"email": email, "password": password, "device_fingerprint": device}):
+            return
+        user = await self.db.users.find_one({"email": email}, {"verification_code": 1})
+        if not await self.timed("auth.verify", "POST", "/verify-email",
+                                json={"email": email, "verification_code": user["verification_code"]}):
+            return
+        await self.timed("auth.login", "POST", "/login",
+                         json={"email": email, "password": password, "device_fingerprint": random_token()})
+
+    async def scenario_order(self):
+        payload = {"product_id": random.choice(self.product_ids), "payment_method": "paypal"}
+        if self.affiliate_codes and random.random() < 0.3:
+            payload["affiliate_code"] = random.choice(self.affiliate_codes)
+        await self.timed("order.create", "POST", "/order", json=payload,
+                         headers={"Idempotency-Key": uuid.uuid4().hex})
+
+    async def scenario_affiliate(self):
+        code = random.choice(self.affiliate_codes)
+        await self.timed("affiliate.click", "GET", f"/r/{code}", expected=(302,))
+        await self.timed("affiliate.dashboard", "GET", f"/affiliate/{code}")
+
+    async def run(self, mix, duration, warmup, concurrency, rate):
+        """Closed loop at ``concurrency`` users, or open loop at ``rate`` scenarios/s if set."""
+        names = list(mix)
+        weights = [mix[name] for name in names]
+        scenarios = {name: getattr(self, f"scenario_{name}") for name in names}
+        deadline = time.perf_counter() + warmup + duration
+
+        async def warm_then_record():
+            await asyncio.sleep(warmup)
+            self.recorder.start()
+
+        async def user():
+            while time.perf_counter() < deadline:
+                await scenarios[random.choices(names, weights)[0]]()
+
+        async def paced():
+            slots = asyncio.Semaphore(concurrency)
+            pending = set()
+            next_start = time.perf_counter()
+            while next_start < deadline:
+                await asyncio.sleep(max(0.0, next_start - time.perf_counter()))
+                await slots.acquire()
+                task = asyncio.create_task(scenarios[random.choices(names, weights)[0]]())
+                task.add_done_callback(lambda _: slots.release())
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+                next_start += random.expovariate(rate)
+            await asyncio.gather(*pending)
+
+        marker = asyncio.create_task(warm_then_record())
+        if rate:
+            await paced()
+        else:
+            await asyncio.gather(*(user() for _ in range(concurrency)))
+        await marker
+        self.recorder.stop()
+
+
+def parse_mix(value):
+    if value in MIXES:
+        return MIXES[value]
+    mix = {}
+    for part in value.split(','):
+        name, weight = part.split('=')
+        if not hasattr(ShopLuxeBenchmark, f"scenario_{name.strip()}"):
+            raise argparse.ArgumentTypeError(f"Unknown scenario: {name}")
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+def serialization_micro(iterations):
+    """Per-response serialization cost of FastAPI's default path versus the fast path."""
+    sys.path.insert(0, str(BACKEND_DIR))
+    os.environ.setdefault('AFFILIATE_CODE_SECRET', secrets.token_urlsafe(32))
+    import server
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+
+    products = list(server.catalog_store.current.by_id.values())
+    raw_products = [
+        {**product, "category": category,
+         "final_price": server.calculate_final_price(product["original_price"], product["discount"])}
+        for category, items in server.PRODUCTS.items() for product in items
+    ]
+    now = datetime.utcnow()
+    payloads = {
+        "product": products[0],
+        "products_page": {"items": products[:20], "next_cursor": "cursor"},
+        "products_batch": {"products": (products * (100 // len(products) + 1))[:100], "not_found": []},
+        "affiliate_summary": {
+            "affiliate_code": "LUX0000000", "total_clicks": 1234, "total_sales": 56,
+            "commission_balance": 120.5, "commission_earned": 300.25, "commission_withdrawn": 179.75,
+            "current_commission_rate": 9.0
+        },
+        "orders_page": {
+            "items": [
+                {"id": str(uuid.uuid4()), "product_id": "aes_002", "product_name": "Gold Cuban Link Chain",
+                 "final_price": 127.5, "payment_method": "paypal", "payment_status": "pending", "created_at": now}
+                for _ in range(20)
+            ],
+            "next_cursor": "cursor"
+        },
+    }
+
+    def per_call_us(fn):
+        return round(1e6 * min(timeit.repeat(fn, number=iterations, repeat=5)) / iterations, 2)
+
+    report = {"timestamp": datetime.now().isoformat(), "iterations": iterations, "serialization_us": {}}
+    for name, payload in payloads.items():
+        before = per_call_us(lambda: JSONResponse(jsonable_encoder(payload)).body)
+        after = per_call_us(lambda: server.FastJSONResponse(payload).body)
+        report["serialization_us"][name] = {"before": before, "after": after, "speedup": round(before / after, 1)}
+
+    # pydantic-core validates in Rust while model_construct runs in Python, so
+    # "trusted" construction is not the cheap path it was under pydantic v1
+    validated = per_call_us(lambda: [server.Product(**product) for product in raw_products])
+    constructed = per_call_us(lambda: [server.Product.model_construct(**product) for product in raw_products])
+    report["product_construction_us"] = {
+        "products": len(raw_products), "validated": validated, "model_construct": constructed
+    }
+    return report
+
+
+def compare(report, baseline, tolerance):
+    """Per-operation regressions against a baseline report; empty means no regression."""
+    regressions = []
+    for operation, current in report["operations"].items():
+        previous = baseline.get("operations", {}).get(operation)
+        if not previous:
+            continue
+        for pct in PERCENTILES:
+            key = f"p{pct}_ms"
+            if previous[key] and current[key] and current[key] > previous[key] * (1 + tolerance):
+                regressions.append(f"{operation} {key}: {previous[key]} -> {current[key]}")
+        if current["throughput_rps"] < previous["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{operation} throughput_rps: {previous['throughput_rps']} -> {current['throughput_rps']}")
+        if current["error_rate"] > previous["error_rate"] + 0.01:
+            regressions.append(f"{operation} error_rate: {previous['error_rate']} -> {current['error_rate']}")
+    return regressions
+
+
+async def main(args):
+    load_dotenv(BACKEND_DIR / '.env')
+    mongo = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = mongo[os.environ['DB_NAME']]
+
+    lifespan = contextlib.nullcontext()
+    if args.in_process:
+        # Every virtual user shares one client address, so lift the per-IP and
+        # per-device auth limits that would otherwise throttle the run itself
+        os.environ.setdefault('AUTH_RATE_LIMIT_IP', '1000000/1')
+        os.environ.setdefault('AUTH_RATE_LIMIT_DEVICE', '1000000/1')
+        os.environ.setdefault('AFFILIATE_CODE_SECRET', secrets.token_urlsafe(32))
+        sys.path.insert(0, str(BACKEND_DIR))
+        import server
+        # Startup and shutdown live in the app's lifespan, which ASGITransport doesn't run
+        lifespan = server.app.router.lifespan_context(server.app)
+        transport = httpx.ASGITransport(app=server.app)
+        base_url = "http://shopluxe.bench"
+    else:
+        transport = httpx.AsyncHTTPTransport(limits=httpx.Limits(max_connections=args.concurrency))
+        base_url = args.url
+
+    recorder = Recorder()
+    try:
+        async with lifespan:
+            async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=args.timeout) as client:
+                bench = ShopLuxeBenchmark(client, db, recorder)
+                await bench.setup()
+                await bench.run(args.mix, args.duration, args.warmup, args.concurrency, args.rate)
+    finally:
+        mongo.close()
+
+    elapsed = recorder.finished - recorder.started
+    all_samples = [sample for samples in recorder.samples.values() for sample in samples]
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "target": "in-process" if args.in_process else args.url,
+        "config": {
+            "mix": args.mix, "duration": args.duration, "warmup": args.warmup,
+            "concurrency": args.concurrency, "rate": args.rate
+        },
+        "elapsed_seconds": round(elapsed, 3),
+        "overall": summarize(all_samples, elapsed),
+        "operations": {operation: summarize(samples, elapsed) for operation, samples in sorted(recorder.samples.items())},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the ShopLuxe backend API.")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--url", default=DEFAULT_URL, help="Base URL of a running backend")
+    target.add_argument("--in-process", action="store_true", help="Drive backend/server.py in this process")
+    target.add_argument("--micro", action="store_true", help="Run serialization micro-benchmarks instead")
+    parser.add_argument("--iterations", type=int, default=2000, help="Calls per micro-benchmark sample")
+    parser.add_argument("--mix", type=parse_mix, default=MIXES["default"],
+                        help=f"Preset ({', '.join(MIXES)}) or weights like browse=70,order=30")
+    parser.add_argument("--duration", type=float, default=30, help="Measured seconds")
+    parser.add_argument("--warmup", type=float, default=5, help="Unmeasured seconds before measuring")
+    parser.add_argument("--concurrency", type=int, default=16, help="Virtual users, or in-flight cap with --rate")
+    parser.add_argument("--rate", type=float, default=0, help="Scenarios started per second (open loop)")
+    parser.add_argument("--timeout", type=float, default=30, help="Per-request timeout in seconds")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="Compare against this stored report")
+    parser.add_argument("--save-baseline", help="Also store the report as a baseline here")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed relative regression vs baseline")
+    args = parser.parse_args()
+
+    report = serialization_micro(args.iterations) if args.micro else asyncio.run(main(args))
+    regressions = []
+    if args.baseline and not args.micro:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        report["regressions"] = regressions
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+    else:
+        print(text)
+    if args.save_baseline:
+        Path(args.save_baseline).write_text(text + "\n")
+
+    # Exit with appropriate code
+    exit(1 if regressions else 0)
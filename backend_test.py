@@ -5,18 +5,69 @@ Tests all core functionality including authentication, products, orders, and aff
 """
 
 import requests
+import base64
+import brotli
+import gzip
+import io
 import json
 import time
 import random
 import string
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from pathlib import Path
 import os
-from dotenv import load_dotenv
+import subprocess
+import sys
+from dotenv import dotenv_values, load_dotenv
+from PIL import Image, ImageOps
+from pymongo import MongoClient
 
 # Load environment variables
 load_dotenv('/app/frontend/.env')
 BASE_URL = os.getenv('REACT_APP_BACKEND_URL', 'http://localhost:8001')
 API_BASE = f"{BASE_URL}/api"
+# Original product images the backend must be started with (IMAGE_ORIGINALS_DIR)
+IMAGE_FIXTURES_DIR = Path(__file__).parent / "tests" / "fixtures" / "images"
+BACKEND_DIR = Path(__file__).parent / "backend"
+
+def backend_settings():
+    """The backend's configuration: backend/.env overridden by the environment"""
+    return {**dotenv_values(BACKEND_DIR / ".env"), **os.environ}
+
+def backend_db():
+    """The backend's own MongoDB database (backend/.env), for state the API doesn't expose"""
+    settings = backend_settings()
+    return MongoClient(settings["MONGO_URL"], serverSelectionTimeoutMS=5000)[settings["DB_NAME"]]
+
+def run_manage(*args):
+    """Run a backend/manage.py command against the same database"""
+    return subprocess.run([sys.executable, "manage.py", *args], cwd=BACKEND_DIR,
+                          capture_output=True, text=True, timeout=120)
+
+def run_backend(script):
+    """Run a Python snippet with the backend importable, against the same database"""
+    return subprocess.run([sys.executable, "-c", script], cwd=BACKEND_DIR,
+                          capture_output=True, text=True, timeout=120)
+
+# Two allocators with tiny blocks, so they reserve over and over in parallel
+ALLOCATOR_RACE = """
+import asyncio, json, server
+
+async def main():
+    server.connect_mongo()
+    try:
+        allocators = [server.AffiliateCodeAllocator(3), server.AffiliateCodeAllocator(3)]
+        for allocator in allocators:
+            allocator.start()
+        codes = await asyncio.gather(*(allocator.allocate() for _ in range(30) for allocator in allocators))
+        print(json.dumps(codes))
+    finally:
+        server.client.close()
+
+asyncio.run(main())
+"""
 
 class ShopLuxeAPITester:
     def __init__(self):
@@ -186,6 +237,432 @@ class ShopLuxeAPITester:
         
         return all_passed
     
+    def test_product_listing_queries(self):
+        """Test GET /api/products/{category} with filters, sorting and cursor pagination"""
+        category = "social"  # the only category mixing verified accounts and goods
+        sort_keys = {
+            "price": lambda p: p["final_price"],
+            "discount": lambda p: p["discount"],
+            "name": lambda p: p["name"].casefold(),
+        }
+        all_passed = True
+
+        def fetch_all(**params):
+            """Follow next_cursor to the end, returning every item in the order served"""
+            items, cursor = [], None
+            for _ in range(50):
+                response = self.session.get(f"{API_BASE}/products/{category}",
+                                            params={**params, **({"cursor": cursor} if cursor else {})})
+                response.raise_for_status()
+                data = response.json()
+                items.extend(data["items"])
+                cursor = data["next_cursor"]
+                if not cursor:
+                    return items
+            raise RuntimeError("next_cursor never ran out")
+
+        try:
+            products = self.session.get(f"{API_BASE}/products/{category}").json()
+        except Exception as e:
+            self.log_test("Listing Queries", False, f"Error: {str(e)}")
+            return False
+
+        for sort, key in sort_keys.items():
+            for order in ("asc", "desc"):
+                name = f"Listing Sort - {sort} {order}"
+                try:
+                    items = fetch_all(sort=sort, order=order, limit=3)
+                    ids = [p["id"] for p in items]
+                    expected = [p["id"] for p in sorted(products, key=lambda p: (key(p), p["id"]),
+                                                         reverse=order == "desc")]
+                    if ids == expected:
+                        self.log_test(name, True, f"{len(ids)} products over {-(-len(ids) // 3)} pages, no repeats")
+                    else:
+                        self.log_test(name, False, f"Expected {expected}, got {ids}")
+                        all_passed = False
+                except Exception as e:
+                    self.log_test(name, False, f"Error: {str(e)}")
+                    all_passed = False
+
+        prices = sorted(p["final_price"] for p in products)
+        low, high = prices[len(prices) // 4], prices[3 * len(prices) // 4]
+        discounts = sorted(p["discount"] for p in products)
+        filters = [
+            ({"min_price": low, "max_price": high}, lambda p: low <= p["final_price"] <= high),
+            ({"min_discount": discounts[len(discounts) // 2]},
+             lambda p: p["discount"] >= discounts[len(discounts) // 2]),
+            ({"verified": "true"}, lambda p: p.get("verified", False)),
+            ({"is_account": "true"}, lambda p: p.get("is_account", False)),
+            ({"verified": "true", "min_price": low, "sort": "discount", "order": "desc"},
+             lambda p: p.get("verified", False) and p["final_price"] >= low),
+        ]
+        for params, predicate in filters:
+            name = f"Listing Filter - {', '.join(f'{k}={v}' for k, v in params.items())}"
+            try:
+                ids = {p["id"] for p in fetch_all(limit=2, **params)}
+                expected = {p["id"] for p in products if predicate(p)}
+                if ids == expected:
+                    self.log_test(name, True, f"{len(ids)} matching products")
+                else:
+                    self.log_test(name, False, f"Expected {sorted(expected)}, got {sorted(ids)}")
+                    all_passed = False
+            except Exception as e:
+                self.log_test(name, False, f"Error: {str(e)}")
+                all_passed = False
+
+        name = "Listing Cursor Errors"
+        try:
+            first = self.session.get(f"{API_BASE}/products/{category}", params={"sort": "price", "limit": 2}).json()
+            cases = [
+                ({"cursor": "not-a-cursor"}, "Invalid cursor"),
+                ({"cursor": first["next_cursor"], "order": "desc"}, "Cursor does not match sort order"),
+                ({"cursor": first["next_cursor"], "sort": "name"}, "Invalid cursor"),
+            ]
+            # Well-formed cursors whose sort value has the wrong type for the sort
+            for sort, value in [("price", "abc"), ("price", True), ("discount", {"a": 1}), ("name", 5)]:
+                raw = json.dumps([sort, "asc", value, "soc_001"]).encode()
+                crafted = base64.urlsafe_b64encode(raw).decode().rstrip("=")
+                cases.append(({"cursor": crafted, "sort": sort}, "Invalid cursor"))
+            for params, detail in cases:
+                response = self.session.get(f"{API_BASE}/products/{category}", params=params)
+                if response.status_code != 400 or response.json().get("detail") != detail:
+                    self.log_test(name, False, f"Expected 400 '{detail}' for {params}, got {response.status_code}",
+                                  response.text)
+                    return False
+            self.log_test(name, True, "Malformed and mismatched cursors rejected with 400")
+        except Exception as e:
+            self.log_test(name, False, f"Error: {str(e)}")
+            all_passed = False
+
+        return all_passed
+
+    def test_search(self):
+        """Test GET /api/search - Prefix matching, multi-term queries and category scoping"""
+        cases = [
+            ("Search - prefix", {"q": "diam"}, lambda ids, items: ids[:1] == ["aes_001"]),
+            ("Search - multi-term", {"q": "silk dre"}, lambda ids, items: ids == ["clo_001"]),
+            ("Search - exact term", {"q": "silk "}, lambda ids, items: set(ids) == {"clo_001", "clo_008"}),
+            ("Search - unscoped", {"q": "luxury"},
+             lambda ids, items: {"aes_003", "clo_002"} <= set(ids)),
+            ("Search - category scope", {"q": "luxury", "category": "aesthetic"},
+             lambda ids, items: "aes_003" in ids and all(p["category"] == "aesthetic" for p in items)),
+            ("Search - limit", {"q": "luxury", "limit": 1}, lambda ids, items: len(ids) == 1),
+            ("Search - no match", {"q": "zzqxv"}, lambda ids, items: ids == []),
+        ]
+        all_passed = True
+
+        for name, params, check in cases:
+            try:
+                response = self.session.get(f"{API_BASE}/search", params=params)
+                if response.status_code != 200:
+                    self.log_test(name, False, f"HTTP {response.status_code}", response.text)
+                    all_passed = False
+                    continue
+                items = response.json()["items"]
+                ids = [p["id"] for p in items]
+                if check(ids, items):
+                    self.log_test(name, True, f"'{params['q']}' returned {ids}")
+                else:
+                    self.log_test(name, False, f"Unexpected results for {params}: {ids}")
+                    all_passed = False
+            except Exception as e:
+                self.log_test(name, False, f"Error: {str(e)}")
+                all_passed = False
+
+        for name, params, expected_status in [
+            ("Search - unknown category", {"q": "ring", "category": "invalid_category"}, 404),
+            ("Search - empty query", {"q": ""}, 422),
+        ]:
+            try:
+                response = self.session.get(f"{API_BASE}/search", params=params)
+                if response.status_code == expected_status:
+                    self.log_test(name, True, f"Correctly returned HTTP {expected_status}")
+                else:
+                    self.log_test(name, False, f"Expected {expected_status}, got {response.status_code}")
+                    all_passed = False
+            except Exception as e:
+                self.log_test(name, False, f"Error: {str(e)}")
+                all_passed = False
+
+        return all_passed
+
+    def test_search_index_update(self):
+        """Test GET /api/search after a product rename - One edited product is patched into the live index"""
+        name = "Search Index Update"
+        product_id = "clo_005"
+        marker = "zq" + ''.join(random.choices(string.ascii_lowercase, k=8))
+
+        def search_ids(q):
+            return [p["id"] for p in self.session.get(f"{API_BASE}/search", params={"q": q}).json()["items"]]
+
+        def wait_for(q, present, timeout=15):
+            deadline = time.time() + timeout
+            while (product_id in search_ids(q)) != present:
+                if time.time() > deadline:
+                    return False
+                time.sleep(0.5)
+            return True
+
+        def rename(db, new_name):
+            db.products.update_one({"id": product_id}, {"$set": {"name": new_name}})
+            # Workers without change streams reload when the catalog version moves
+            db.catalog_meta.update_one({"_id": "version"}, {"$inc": {"version": 1}}, upsert=True)
+
+        try:
+            db = backend_db()
+            original_name = db.products.find_one({"id": product_id})["name"]
+            rename(db, f"{original_name} {marker.capitalize()}")
+            try:
+                if not wait_for(marker, True):
+                    self.log_test(name, False, f"Renamed {product_id} never became searchable as '{marker}'")
+                    return False
+                if product_id not in search_ids(original_name) or product_id not in search_ids(marker[:5]):
+                    self.log_test(name, False, f"{product_id} lost its old terms or prefix match after the rename")
+                    return False
+            finally:
+                rename(db, original_name)
+
+            if not wait_for(marker, False):
+                self.log_test(name, False, f"'{marker}' still matched {product_id} after the name was restored")
+                return False
+            self.log_test(name, True, f"{product_id} was found as '{marker}' after the rename and dropped after the restore")
+            return True
+        except Exception as e:
+            self.log_test(name, False, f"Error: {str(e)}")
+            return False
+
+    def test_products_batch(self):
+        """Test POST /api/products/batch - Several products in one request, deduplicated, unknown ids reported"""
+        name = "Products Batch"
+        try:
+            response = self.session.post(f"{API_BASE}/products/batch",
+                                         json={"ids": ["aes_001", "clo_001", "aes_001", "missing_001"]})
+            if response.status_code != 200:
+                self.log_test(name, False, f"HTTP {response.status_code}", response.text)
+                return False
+            data = response.json()
+            ids = [p["id"] for p in data["products"]]
+            if ids != ["aes_001", "clo_001"] or data["not_found"] != ["missing_001"]:
+                self.log_test(name, False, "Expected aes_001, clo_001 and missing_001 not found", data)
+                return False
+            single = self.session.get(f"{API_BASE}/product/clo_001").json()
+            if data["products"][1] != single:
+                self.log_test(name, False, "Batch entry differs from GET /api/product/clo_001", data["products"][1])
+                return False
+
+            for ids, label in [([], "empty"), ([f"aes_{i:03d}" for i in range(101)], "over 100 ids")]:
+                response = self.session.post(f"{API_BASE}/products/batch", json={"ids": ids})
+                if response.status_code != 422:
+                    self.log_test(name, False, f"Expected 422 for {label}, got {response.status_code}")
+                    return False
+
+            self.log_test(name, True, "Duplicates collapsed, unknown ids listed, empty and oversized batches rejected")
+            return True
+        except Exception as e:
+            self.log_test(name, False, f"Error: {str(e)}")
+            return False
+
+    def test_catalog_etag_revalidation(self):
+        """Test ETag / If-None-Match revalidation on catalog endpoints"""
+        endpoints = [f"{API_BASE}/categories", f"{API_BASE}/products/aesthetic"]
+        all_passed = True
+        
+        for endpoint in endpoints:
+            name = f"Catalog ETag - {endpoint.split('/')[-1]}"
+            try:
+                response = self.session.get(endpoint)
+                etag = response.headers.get("ETag")
+                if response.status_code != 200 or not etag:
+                    self.log_test(name, False, f"HTTP {response.status_code}, ETag={etag}")
+                    all_passed = False
+                    continue
+                
+                revalidated = self.session.get(endpoint, headers={"If-None-Match": etag})
+                if revalidated.status_code == 304 and not revalidated.content:
+                    self.log_test(name, True, f"Revalidation returned 304 for {etag}")
+                else:
+                    self.log_test(name, False, f"Expected 304, got {revalidated.status_code}")
+                    all_passed = False
+            except Exception as e:
+                self.log_test(name, False, f"Error: {str(e)}")
+                all_passed = False
+        
+        return all_passed
+    
+    def test_compression_negotiation(self):
+        """Test Accept-Encoding negotiation - br, gzip or identity bodies, Vary, and a 304 per encoding's ETag"""
+        decoders = {"br": brotli.decompress, "gzip": gzip.decompress, None: lambda body: body}
+        cached = [f"{API_BASE}/categories", f"{API_BASE}/products/aesthetic"]
+        dynamic = [f"{API_BASE}/search?q=luxury&limit=50"]
+        all_passed = True
+
+        def fetch(url, accept, etag=None):
+            headers = {"Accept-Encoding": accept}
+            if etag:
+                headers["If-None-Match"] = etag
+            response = self.session.get(url, headers=headers, stream=True)
+            # Undecoded, to see exactly what was put on the wire
+            return response, response.raw.read(decode_content=False)
+
+        for url in cached + dynamic:
+            name = f"Compression - {url.split('/')[-1]}"
+            try:
+                failure = None
+                expected_body = None
+                etags = {}
+                for accept, expected in (("identity", None), ("gzip", "gzip"), ("br", "br")):
+                    response, raw = fetch(url, accept)
+                    encoding = response.headers.get("Content-Encoding")
+                    vary = response.headers.get("Vary", "")
+                    if response.status_code != 200 or encoding != expected:
+                        failure = f"'{accept}': HTTP {response.status_code}, Content-Encoding {encoding}"
+                    elif expected and "accept-encoding" not in vary.lower():
+                        failure = f"'{accept}': Vary is '{vary}'"
+                    elif expected_body is not None and decoders[encoding](raw) != expected_body:
+                        failure = f"'{accept}': decoded body differs from the identity body"
+                    if failure:
+                        break
+                    expected_body = decoders[encoding](raw)
+                    etags[accept] = response.headers.get("ETag")
+
+                if not failure and url in cached:
+                    if len(set(etags.values())) != len(etags):
+                        failure = f"Encodings share an ETag: {etags}"
+                    for accept, etag in etags.items():
+                        if failure:
+                            break
+                        revalidated, _ = fetch(url, accept, etag)
+                        vary = revalidated.headers.get("Vary", "").lower()
+                        if revalidated.status_code != 304 or "accept-encoding" not in vary:
+                            failure = f"'{accept}' revalidation with {etag}: HTTP {revalidated.status_code}"
+                        # Another encoding's ETag names a different representation
+                        other = etags["gzip" if accept != "gzip" else "br"]
+                        if not failure and fetch(url, accept, other)[0].status_code != 200:
+                            failure = f"'{accept}' revalidated against {other}, another encoding's ETag"
+
+                if failure:
+                    self.log_test(name, False, failure)
+                    all_passed = False
+                else:
+                    self.log_test(name, True, "identity, gzip and br negotiated"
+                                  + (", each revalidated by its own ETag" if url in cached else ""))
+            except Exception as e:
+                self.log_test(name, False, f"Error: {str(e)}")
+                all_passed = False
+
+        return all_passed
+
+    def test_image_derivatives(self):
+        """Test GET /api/img/{product_id} - Resized derivatives of the local fixture originals
+        
+        The backend must run with IMAGE_ORIGINALS_DIR pointing at tests/fixtures/images.
+        """
+        name = "Image Derivatives"
+        fixtures = sorted(IMAGE_FIXTURES_DIR.iterdir())
+        try:
+            for fixture in fixtures:
+                product_id = fixture.stem
+                with Image.open(fixture) as original:
+                    original_width, original_height = ImageOps.exif_transpose(original).size
+                
+                product = self.session.get(f"{API_BASE}/product/{product_id}").json()
+                if not product.get("thumbnail") or not product.get("image_srcset"):
+                    self.log_test(name, False, f"No derivative URLs for {product_id}; start the backend with "
+                                               f"IMAGE_ORIGINALS_DIR={IMAGE_FIXTURES_DIR}", product)
+                    return False
+                
+                thumbnail = f"{BASE_URL}{product['thumbnail']}"
+                first = self.session.get(thumbnail)
+                second = self.session.get(thumbnail)
+                if first.status_code != 200 or first.headers.get("Content-Type") != "image/webp":
+                    self.log_test(name, False, f"{product_id}: HTTP {first.status_code}, "
+                                               f"Content-Type={first.headers.get('Content-Type')}")
+                    return False
+                if "immutable" not in first.headers.get("Cache-Control", ""):
+                    self.log_test(name, False, f"Versioned derivative not immutable: {first.headers.get('Cache-Control')}")
+                    return False
+                if first.content != second.content:
+                    self.log_test(name, False, f"{product_id}: cached derivative differs from the first render")
+                    return False
+                
+                # Thumbnails are 480px wide, never upscaled, with the original's upright aspect ratio
+                with Image.open(io.BytesIO(first.content)) as rendered:
+                    width, height = rendered.size
+                expected_width = min(480, original_width)
+                if width != expected_width or abs(height - original_height * expected_width / original_width) > 1:
+                    self.log_test(name, False, f"{product_id}: expected {expected_width}px wide with the original's "
+                                               f"aspect ratio {original_width}x{original_height}, got {width}x{height}")
+                    return False
+                
+                # Requested widths snap up to the next allowed width
+                jpeg = self.session.get(f"{API_BASE}/img/{product_id}?w=100&fmt=jpeg")
+                with Image.open(io.BytesIO(jpeg.content)) as rendered:
+                    if jpeg.headers.get("Content-Type") != "image/jpeg" or rendered.format != "JPEG" \
+                            or rendered.width != min(160, original_width):
+                        self.log_test(name, False, f"{product_id}: expected a 160px JPEG, got "
+                                                   f"{rendered.format} {rendered.size}")
+                        return False
+            
+            invalid = self.session.get(f"{API_BASE}/img/{fixtures[0].stem}?fmt=gif")
+            if invalid.status_code != 422:
+                self.log_test(name, False, f"Expected 422 for unsupported format, got {invalid.status_code}")
+                return False
+            missing = self.session.get(f"{API_BASE}/img/aes_010")
+            if missing.status_code != 404:
+                self.log_test(name, False, f"Expected 404 for a product without an original, got {missing.status_code}")
+                return False
+            self.log_test(name, True, f"Derivatives of {len(fixtures)} fixture originals resized and cached")
+            return True
+        except Exception as e:
+            self.log_test(name, False, f"Error: {str(e)}")
+            return False
+    
+    def test_promotion_schedule(self):
+        """Test manage.py promote - A timed category promotion reprices the catalog and reverts at ends_at"""
+        name = "Promotion Schedule"
+        product_url = f"{API_BASE}/product/clo_001"
+
+        def wait_for_discount(expected, deadline):
+            while True:
+                product = self.session.get(product_url).json()
+                if product["discount"] == expected or time.time() > deadline:
+                    return product
+                time.sleep(0.5)
+
+        try:
+            before = self.session.get(product_url).json()
+            promoted_discount = min(before["discount"] + 10, 100)
+
+            result = run_manage("promote", "--category", "clothes", "--extra-discount", "10", "--ends-in", "15")
+            if result.returncode != 0:
+                self.log_test(name, False, f"manage.py exited with {result.returncode}", result.stderr[-1000:])
+                return False
+            ends_at = time.time() + 15
+
+            product = wait_for_discount(promoted_discount, time.time() + 10)
+            expected_price = round(product["original_price"] * (1 - promoted_discount / 100), 2)
+            if product["discount"] != promoted_discount or abs(product["final_price"] - expected_price) > 0.01:
+                self.log_test(name, False, f"Expected {promoted_discount}% off at ${expected_price}", product)
+                return False
+
+            listed = {p["id"]: p for p in self.session.get(f"{API_BASE}/products/clothes").json()}
+            unaffected = self.session.get(f"{API_BASE}/product/aes_001").json()
+            if listed["clo_001"]["final_price"] != product["final_price"] or unaffected["discount"] > 30:
+                self.log_test(name, False, "Listing and product detail disagree, or another category was discounted")
+                return False
+
+            reverted = wait_for_discount(before["discount"], ends_at + 10)
+            if reverted["discount"] != before["discount"] or reverted["final_price"] != before["final_price"]:
+                self.log_test(name, False, "Price did not revert after ends_at", reverted)
+                return False
+
+            self.log_test(name, True, f"clo_001 went from ${before['final_price']} to ${product['final_price']} "
+                                      f"and back when the promotion ended")
+            return True
+        except Exception as e:
+            self.log_test(name, False, f"Error: {str(e)}")
+            return False
+
     def test_user_signup(self):
         """Test POST /api/signup - User registration"""
         try:
@@ -236,6 +713,35 @@ class ShopLuxeAPITester:
             self.log_test("Duplicate Signup Prevention", False, f"Error: {str(e)}")
             return False
     
+    def test_concurrent_duplicate_signup(self):
+        """Test that concurrent signups with one email create exactly one account"""
+        email = f"race_{random.randint(100000, 999999)}@luxetest.com"
+        payload = {
+            "email": email,
+            "password": self.test_password,
+            "device_fingerprint": self.device_fingerprint
+        }
+        attempts = 10
+        
+        try:
+            with ThreadPoolExecutor(max_workers=attempts) as executor:
+                responses = list(executor.map(
+                    lambda _: requests.post(f"{API_BASE}/signup", json=payload), range(attempts)
+                ))
+            
+            statuses = [response.status_code for response in responses]
+            created = statuses.count(200)
+            rejected = statuses.count(400)
+            if created == 1 and rejected == attempts - 1:
+                self.log_test("Concurrent Duplicate Signup", True, f"1 of {attempts} concurrent signups succeeded")
+                return True
+            else:
+                self.log_test("Concurrent Duplicate Signup", False, f"Expected 1 success and {attempts - 1} rejections, got {statuses}")
+                return False
+        except Exception as e:
+            self.log_test("Concurrent Duplicate Signup", False, f"Error: {str(e)}")
+            return False
+    
     def test_email_verification(self):
         """Test POST /api/verify-email - Email verification with 5-digit code"""
         # Since we can't access the actual email, we'll test with a mock code
@@ -304,6 +810,104 @@ class ShopLuxeAPITester:
             self.log_test("User Login", False, f"Error: {str(e)}")
             return False
     
+    def create_verified_session(self):
+        """Sign up a fresh user, verify it with the code stored in MongoDB, and return (email, token)"""
+        email = f"session_{uuid.uuid4().hex[:12]}@luxetest.com"
+        response = self.session.post(f"{API_BASE}/signup", json={
+            "email": email, "password": self.test_password, "device_fingerprint": self.generate_device_fingerprint()
+        })
+        response.raise_for_status()
+        code = backend_db().users.find_one({"email": email})["verification_code"]
+        response = self.session.post(f"{API_BASE}/verify-email", json={"email": email, "verification_code": code})
+        response.raise_for_status()
+        return email, response.json()["session_token"]
+
+    def test_me_and_logout(self):
+        """Test GET /api/me and POST /api/logout - Bearer sessions resolve, and logout revokes them"""
+        name = "Session Me and Logout"
+        try:
+            email, token = self.create_verified_session()
+            headers = {"Authorization": f"Bearer {token}"}
+
+            me = self.session.get(f"{API_BASE}/me", headers=headers)
+            if me.status_code != 200 or me.json().get("email") != email:
+                self.log_test(name, False, f"/me with a fresh token: HTTP {me.status_code}", me.text)
+                return False
+
+            anonymous = self.session.get(f"{API_BASE}/me")
+            forged = self.session.get(f"{API_BASE}/me", headers={"Authorization": "Bearer not-a-session"})
+            if anonymous.status_code != 401 or forged.status_code != 401:
+                self.log_test(name, False, f"Expected 401 without a valid token, got "
+                                           f"{anonymous.status_code} and {forged.status_code}")
+                return False
+
+            logout = self.session.post(f"{API_BASE}/logout", headers=headers)
+            if logout.status_code != 200 or not logout.json().get("success"):
+                self.log_test(name, False, f"Logout failed: HTTP {logout.status_code}", logout.text)
+                return False
+
+            revoked = self.session.get(f"{API_BASE}/me", headers=headers)
+            if revoked.status_code != 401:
+                self.log_test(name, False, f"Expected 401 after logout, got {revoked.status_code}", revoked.text)
+                return False
+
+            self.log_test(name, True, f"/me resolved {email}; the token was rejected after logout")
+            return True
+        except Exception as e:
+            self.log_test(name, False, f"Error: {str(e)}")
+            return False
+
+    def test_order_history(self):
+        """Test GET /api/orders - Authenticated order history linked to the user, paged newest first"""
+        name = "Order History"
+        try:
+            unauthenticated = self.session.get(f"{API_BASE}/orders")
+            if unauthenticated.status_code != 401:
+                self.log_test(name, False, f"Expected 401 without a session, got {unauthenticated.status_code}")
+                return False
+
+            _, token = self.create_verified_session()
+            headers = {"Authorization": f"Bearer {token}"}
+            placed = []
+            for product_id in ("aes_004", "clo_003", "soc_001", "aes_009", "clo_006"):
+                response = self.session.post(f"{API_BASE}/order", headers=headers,
+                                             json={"product_id": product_id, "payment_method": "paypal"})
+                response.raise_for_status()
+                placed.append(response.json()["order_id"])
+            # An anonymous order must not show up in anyone's history
+            self.session.post(f"{API_BASE}/order", json={"product_id": "aes_004", "payment_method": "paypal"})
+
+            seen, cursor, pages = [], None, 0
+            while True:
+                params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+                response = self.session.get(f"{API_BASE}/orders", headers=headers, params=params)
+                if response.status_code != 200:
+                    self.log_test(name, False, f"HTTP {response.status_code} on page {pages + 1}", response.text)
+                    return False
+                data = response.json()
+                seen.extend(data["items"])
+                pages += 1
+                cursor = data["next_cursor"]
+                if not cursor or pages > 5:
+                    break
+
+            seen_ids = [order["id"] for order in seen]
+            created = [datetime.fromisoformat(order["created_at"]) for order in seen]
+            if sorted(seen_ids) != sorted(placed) or created != sorted(created, reverse=True):
+                self.log_test(name, False, f"Expected {placed} newest first, got {seen_ids} over {pages} pages")
+                return False
+
+            invalid = self.session.get(f"{API_BASE}/orders", headers=headers, params={"cursor": "not-a-cursor"})
+            if invalid.status_code != 400:
+                self.log_test(name, False, f"Expected 400 for an invalid cursor, got {invalid.status_code}")
+                return False
+
+            self.log_test(name, True, f"{len(placed)} orders returned newest first over {pages} pages")
+            return True
+        except Exception as e:
+            self.log_test(name, False, f"Error: {str(e)}")
+            return False
+
     def test_create_order_paypal(self):
         """Test POST /api/order - Order creation with PayPal"""
         try:
@@ -360,6 +964,40 @@ class ShopLuxeAPITester:
             self.log_test("Create Order - Card", False, f"Error: {str(e)}")
             return False
     
+    def test_order_idempotency(self):
+        """Test POST /api/order with Idempotency-Key - Concurrent duplicates coalesce and retries replay"""
+        name = "Order Idempotency"
+        payload = {"product_id": "clo_002", "payment_method": "paypal"}
+        headers = {"Idempotency-Key": str(uuid.uuid4())}
+        attempts = 5
+        
+        try:
+            with ThreadPoolExecutor(max_workers=attempts) as executor:
+                responses = list(executor.map(
+                    lambda _: requests.post(f"{API_BASE}/order", json=payload, headers=headers), range(attempts)
+                ))
+            statuses = [response.status_code for response in responses]
+            order_ids = {response.json().get("order_id") for response in responses if response.status_code == 200}
+            if statuses != [200] * attempts or len(order_ids) != 1:
+                self.log_test(name, False, f"Expected {attempts} responses for one order, got {statuses} and {order_ids}")
+                return False
+            
+            retry = self.session.post(f"{API_BASE}/order", json=payload, headers=headers)
+            if retry.status_code != 200 or retry.json().get("order_id") not in order_ids:
+                self.log_test(name, False, f"Retry did not replay the first order: HTTP {retry.status_code}", retry.text)
+                return False
+            
+            reused = self.session.post(f"{API_BASE}/order", json={**payload, "product_id": "clo_003"}, headers=headers)
+            if reused.status_code != 422:
+                self.log_test(name, False, f"Expected 422 for a key reused with another body, got {reused.status_code}")
+                return False
+            
+            self.log_test(name, True, f"{attempts} concurrent submissions and a retry all returned order {order_ids.pop()}")
+            return True
+        except Exception as e:
+            self.log_test(name, False, f"Error: {str(e)}")
+            return False
+    
     def test_affiliate_signup(self):
         """Test POST /api/affiliate/signup - Affiliate program registration"""
         try:
@@ -390,6 +1028,45 @@ class ShopLuxeAPITester:
             self.log_test("Affiliate Signup", False, f"Error: {str(e)}")
             return False
     
+    def test_affiliate_code_allocation(self):
+        """Test affiliate code blocks - allocators reserving concurrently never hand out the same code
+
+        Two allocators in a separate process race each other and the server's
+        own allocator, which concurrent POST /api/affiliate/signup calls drive.
+        """
+        name = "Affiliate Code Allocation"
+
+        def signup(_):
+            response = requests.post(f"{API_BASE}/affiliate/signup", json={
+                "email": f"alloc_{uuid.uuid4().hex[:12]}@luxetest.com",
+                "paypal_email": f"paypal_{uuid.uuid4().hex[:8]}@luxetest.com"
+            })
+            response.raise_for_status()
+            return response.json()["affiliate_code"]
+
+        try:
+            with ThreadPoolExecutor(max_workers=10) as executor:
+                signups = executor.map(signup, range(20))
+                race = run_backend(ALLOCATOR_RACE)
+                server_codes = list(signups)
+            if race.returncode != 0:
+                self.log_test(name, False, f"Allocator script failed: {race.stderr.strip()[-300:]}")
+                return False
+
+            codes = json.loads(race.stdout.strip().splitlines()[-1]) + server_codes
+            duplicates = sorted({code for code in codes if codes.count(code) > 1})
+            if duplicates:
+                self.log_test(name, False, f"Codes handed out twice: {duplicates}")
+                return False
+            if not all(code.startswith("LUX") for code in codes):
+                self.log_test(name, False, "Malformed codes", codes)
+                return False
+            self.log_test(name, True, f"{len(codes)} codes from three concurrent allocators are all distinct")
+            return True
+        except Exception as e:
+            self.log_test(name, False, f"Error: {str(e)}")
+            return False
+
     def test_affiliate_dashboard(self):
         """Test GET /api/affiliate/{affiliate_code} - Affiliate dashboard data"""
         if not hasattr(self, 'affiliate_code'):
@@ -421,6 +1098,38 @@ class ShopLuxeAPITester:
             self.log_test("Affiliate Dashboard", False, f"Error: {str(e)}")
             return False
     
+    def test_affiliate_clicks(self):
+        """Test GET /api/r/{affiliate_code} - Buffered clicks reach the affiliate exactly once"""
+        name = "Affiliate Clicks"
+        try:
+            code, _ = self.create_affiliate_account(0)
+            for _ in range(5):
+                response = self.session.get(f"{API_BASE}/r/{code}", allow_redirects=False)
+                if response.status_code != 302 or f"ref={code}" not in response.headers.get("location", ""):
+                    self.log_test(name, False, f"Redirect failed: HTTP {response.status_code}",
+                                  dict(response.headers))
+                    return False
+
+            interval = float(backend_settings().get("CLICK_FLUSH_INTERVAL") or 2)
+            db = backend_db()
+
+            def clicks():
+                return db.affiliates.find_one({"unique_code": code})["total_clicks"]
+
+            deadline = time.time() + interval + 10
+            while clicks() < 5 and time.time() < deadline:
+                time.sleep(0.5)
+            # Later flushes must not write the same batch again
+            time.sleep(2 * interval + 1)
+            if clicks() != 5:
+                self.log_test(name, False, f"Expected 5 clicks after the flush, found {clicks()}")
+                return False
+            self.log_test(name, True, "5 redirects counted once after the buffer flushed")
+            return True
+        except Exception as e:
+            self.log_test(name, False, f"Error: {str(e)}")
+            return False
+
     def test_order_with_affiliate(self):
         """Test order creation with affiliate code"""
         if not hasattr(self, 'affiliate_code'):
@@ -450,6 +1159,209 @@ class ShopLuxeAPITester:
             self.log_test("Order with Affiliate", False, f"Error: {str(e)}")
             return False
     
+    def test_attribution_rebuild(self):
+        """Test manage.py rebuild-attribution - Recompute affiliate counters from all orders on the real MongoDB"""
+        name = "Attribution Rebuild"
+        if not hasattr(self, 'affiliate_code'):
+            self.log_test(name, False, "No affiliate code available")
+            return False
+        
+        try:
+            for product_id in ("aes_003", "clo_004"):
+                response = self.session.post(f"{API_BASE}/order", json={
+                    "product_id": product_id, "payment_method": "paypal", "affiliate_code": self.affiliate_code
+                })
+                if response.status_code != 200:
+                    self.log_test(name, False, f"Order for {product_id} failed: HTTP {response.status_code}", response.text)
+                    return False
+            
+            db = backend_db()
+            # Knock the materialized counters out of line so only a rebuild can restore them
+            db.affiliates.update_one({"unique_code": self.affiliate_code}, {"$set": {
+                "total_sales": 0, "commission_earned": 0.0, "commission_balance": 0.0, "attribution_checkpoint": None
+            }})
+            
+            result = run_manage("rebuild-attribution", "--take-over")
+            if result.returncode != 0:
+                self.log_test(name, False, f"manage.py exited with {result.returncode}", result.stderr[-1000:])
+                return False
+            
+            # Every order priced at the tier it was made in: 4% + 1% per 10 earlier sales
+            affiliate = db.affiliates.find_one({"unique_code": self.affiliate_code})
+            orders = list(db.orders.find({"affiliate_code": self.affiliate_code}).sort([("created_at", 1), ("id", 1)]))
+            expected = sum(round(order["final_price"] * (affiliate["commission_rate"] + i // 10) / 100, 2)
+                           for i, order in enumerate(orders))
+            checkpoint = affiliate.get("attribution_checkpoint") or {}
+            if affiliate["total_sales"] != len(orders) or abs(affiliate["commission_earned"] - expected) > 0.01 \
+                    or abs(affiliate["commission_balance"] - (expected - affiliate.get("commission_withdrawn", 0))) > 0.01 \
+                    or checkpoint.get("id") != orders[-1]["id"]:
+                self.log_test(name, False, f"Expected {len(orders)} sales earning {expected:.2f}, got "
+                                           f"{affiliate['total_sales']} sales earning {affiliate['commission_earned']}")
+                return False
+            
+            self.log_test(name, True, f"Rebuilt {len(orders)} sales earning ${expected:.2f}: {result.stdout.strip()}")
+            return True
+        except Exception as e:
+            self.log_test(name, False, f"Error: {str(e)}")
+            return False
+    
+    def create_affiliate_account(self, balance):
+        """A verified user who is also an affiliate with ``balance`` to withdraw; returns (code, headers)"""
+        email, token = self.create_verified_session()
+        response = self.session.post(f"{API_BASE}/affiliate/signup", json={
+            "email": email, "paypal_email": f"paypal_{uuid.uuid4().hex[:8]}@luxetest.com"
+        })
+        response.raise_for_status()
+        code = response.json()["affiliate_code"]
+        backend_db().affiliates.update_one({"unique_code": code}, {"$set": {"commission_balance": balance}})
+        return code, {"Authorization": f"Bearer {token}"}
+
+    def test_affiliate_withdrawals(self):
+        """Test GET/POST /api/affiliate/{code}/withdrawals - Only the affiliate may list or request payouts"""
+        name = "Affiliate Withdrawals"
+        try:
+            code, headers = self.create_affiliate_account(50.0)
+            _, other_token = self.create_verified_session()
+            other = {"Authorization": f"Bearer {other_token}"}
+            url = f"{API_BASE}/affiliate/{code}/withdrawals"
+
+            denied = [
+                ("list without a session", self.session.get(url), 401),
+                ("list as another user", self.session.get(url, headers=other), 403),
+                ("list an unknown code", self.session.get(f"{API_BASE}/affiliate/LUXZZZZZZZ/withdrawals",
+                                                          headers=headers), 404),
+                ("request without a session", self.session.post(url, json={"amount": 5}), 401),
+                ("request as another user", self.session.post(url, json={"amount": 5}, headers=other), 403),
+                ("request over the balance", self.session.post(url, json={"amount": 500}, headers=headers), 400),
+            ]
+            for label, response, expected_status in denied:
+                if response.status_code != expected_status:
+                    self.log_test(name, False, f"Expected {expected_status} to {label}, got {response.status_code}",
+                                  response.text)
+                    return False
+
+            requested = []
+            for amount in (10, 15, 5):
+                response = self.session.post(url, json={"amount": amount}, headers=headers)
+                if response.status_code != 200:
+                    self.log_test(name, False, f"Withdrawal of {amount} failed: HTTP {response.status_code}",
+                                  response.text)
+                    return False
+                requested.append(response.json()["withdrawal"]["id"])
+
+            listed, cursor = [], None
+            for _ in range(5):
+                response = self.session.get(url, headers=headers,
+                                            params={"limit": 2, **({"cursor": cursor} if cursor else {})})
+                response.raise_for_status()
+                listed.extend(response.json()["items"])
+                cursor = response.json()["next_cursor"]
+                if not cursor:
+                    break
+            if sorted(w["id"] for w in listed) != sorted(requested) or sum(w["amount"] for w in listed) != 30:
+                self.log_test(name, False, f"Expected withdrawals {requested} totalling 30", listed)
+                return False
+
+            dashboard = self.session.get(f"{API_BASE}/affiliate/{code}").json()
+            if dashboard["commission_balance"] != 20 or dashboard["commission_withdrawn"] != 30:
+                self.log_test(name, False, "Balance not moved by the withdrawals", dashboard)
+                return False
+
+            self.log_test(name, True, f"3 withdrawals listed over 2 pages for {code}; other users denied")
+            return True
+        except Exception as e:
+            self.log_test(name, False, f"Error: {str(e)}")
+            return False
+
+    def test_withdrawal_migration(self):
+        """Test manage.py migrate-withdrawals - Embedded history moves out exactly once, even run concurrently"""
+        name = "Withdrawal Migration"
+        try:
+            code, headers = self.create_affiliate_account(0.0)
+            db = backend_db()
+            history = [{"amount": 12.5, "status": "paid"}, {"amount": 7.0}]
+            db.affiliates.update_one({"unique_code": code}, {"$set": {"withdrawal_history": history}})
+            db.migrations.delete_one({"_id": "withdrawal_history"})
+
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                results = list(executor.map(lambda _: run_manage("migrate-withdrawals"), range(2)))
+            failed = [result for result in results if result.returncode != 0]
+            if failed:
+                self.log_test(name, False, f"manage.py exited with {failed[0].returncode}", failed[0].stderr[-1000:])
+                return False
+
+            migrated = list(db.withdrawals.find({"affiliate_code": code}))
+            affiliate = db.affiliates.find_one({"unique_code": code})
+            if sorted(w["amount"] for w in migrated) != [7.0, 12.5] or "withdrawal_history" in affiliate \
+                    or not db.migrations.find_one({"_id": "withdrawal_history"}):
+                self.log_test(name, False, f"Expected 2 migrated withdrawals and no embedded history, "
+                                           f"got {len(migrated)}")
+                return False
+
+            listed = self.session.get(f"{API_BASE}/affiliate/{code}/withdrawals", headers=headers).json()["items"]
+            if {w["status"] for w in listed} != {"paid", "pending"}:
+                self.log_test(name, False, "Migrated withdrawals not served by the API", listed)
+                return False
+
+            self.log_test(name, True, "2 embedded withdrawals migrated once by two concurrent runs")
+            return True
+        except Exception as e:
+            self.log_test(name, False, f"Error: {str(e)}")
+            return False
+
+    def test_metrics(self):
+        """Test GET /api/metrics - Prometheus text exposition with request and app metrics"""
+        name = "Metrics"
+        try:
+            response = self.session.get(f"{API_BASE}/metrics")
+            content_type = response.headers.get("Content-Type", "")
+            if response.status_code != 200 or not content_type.startswith("text/plain"):
+                self.log_test(name, False, f"HTTP {response.status_code}, Content-Type={content_type}")
+                return False
+
+            families = [
+                "# TYPE http_requests_total counter",
+                "# TYPE http_request_duration_seconds histogram",
+                "# TYPE catalog_version gauge",
+                "# TYPE password_hash_completed_total counter",
+            ]
+            missing = [family for family in families if family not in response.text]
+            requests_seen = any(line.startswith("http_requests_total{") for line in response.text.splitlines())
+            if missing or not requests_seen:
+                self.log_test(name, False, f"Missing {missing or 'http_requests_total samples'}")
+                return False
+
+            self.log_test(name, True, f"{len(response.text.splitlines())} lines of Prometheus metrics")
+            return True
+        except Exception as e:
+            self.log_test(name, False, f"Error: {str(e)}")
+            return False
+
+    def test_readiness(self):
+        """Test GET /api/health/ready - 200 when every check passes, 503 otherwise, with the checks listed"""
+        name = "Readiness"
+        try:
+            response = self.session.get(f"{API_BASE}/health/ready")
+            data = response.json()
+            checks = data.get("checks", {})
+            if set(checks) != {"mongo_warm", "catalog_loaded", "pool_headroom"}:
+                self.log_test(name, False, "Unexpected checks", data)
+                return False
+
+            ready = all(checks.values())
+            if response.status_code != (200 if ready else 503) or data.get("ready") != ready:
+                self.log_test(name, False, f"HTTP {response.status_code} disagrees with checks", data)
+                return False
+            if not ready:
+                self.log_test(name, False, "Backend reports not ready", data)
+                return False
+
+            self.log_test(name, True, f"Ready, pool saturation {data['pool_saturation']}")
+            return True
+        except Exception as e:
+            self.log_test(name, False, f"Error: {str(e)}")
+            return False
+
     def test_invalid_endpoints(self):
         """Test error handling for invalid endpoints"""
         test_cases = [
@@ -473,6 +1385,85 @@ class ShopLuxeAPITester:
         
         return all_passed
     
+    def test_auth_rate_limit(self):
+        """Test POST /api/login past the per-IP limit - 429 with Retry-After, per forwarded client IP"""
+        name = "Auth Rate Limit"
+        limit = int(backend_settings().get("AUTH_RATE_LIMIT_IP", "60/60").split("/")[0])
+
+        def login(ip):
+            return self.session.post(f"{API_BASE}/login", json={
+                "email": f"limit_{uuid.uuid4().hex[:12]}@luxetest.com",
+                "password": self.test_password,
+                "device_fingerprint": self.generate_device_fingerprint()
+            }, headers={"X-Forwarded-For": ip})
+
+        try:
+            subnet = f"10.{random.randint(0, 99)}.{random.randint(0, 255)}"
+            limited_ip, other_ip = f"{subnet}.1", f"{subnet}.2"
+            # Workers keep their own buckets, so allow for requests spread over several
+            for _ in range(8 * limit):
+                response = login(limited_ip)
+                if response.status_code == 429:
+                    break
+            else:
+                self.log_test(name, False, f"{8 * limit} logins from {limited_ip} were never rate limited")
+                return False
+
+            retry_after = response.headers.get("Retry-After", "")
+            if not retry_after.isdigit() or int(retry_after) < 1:
+                self.log_test(name, False, f"429 without a usable Retry-After: '{retry_after}'", dict(response.headers))
+                return False
+            other = login(other_ip)
+            if other.status_code == 429:
+                self.log_test(name, False, f"{other_ip} shared the bucket of {limited_ip}", other.text)
+                return False
+            self.log_test(name, True, f"{limited_ip} got 429 with Retry-After {retry_after}s; {other_ip} was not limited")
+            return True
+        except Exception as e:
+            self.log_test(name, False, f"Error: {str(e)}")
+            return False
+
+    def test_auth_load_shedding(self):
+        """Test a signup burst past the auth admission queue - the excess is shed with 503 and Retry-After"""
+        name = "Auth Load Shedding"
+        settings = backend_settings()
+        hash_workers = int(settings.get("PASSWORD_HASH_WORKERS") or os.cpu_count() or 2)
+        concurrency = int(settings.get("AUTH_MAX_CONCURRENCY") or 2 * hash_workers)
+        waiting = int(settings.get("AUTH_MAX_WAITING") or 4 * concurrency)
+        burst = 4 * (concurrency + waiting)
+        subnet = random.randint(100, 199)
+
+        def signup(i):
+            # A client IP each, so the per-IP limit never answers first
+            return requests.post(f"{API_BASE}/signup", json={
+                "email": f"shed_{uuid.uuid4().hex[:12]}@luxetest.com",
+                "password": self.test_password,
+                "device_fingerprint": self.generate_device_fingerprint()
+            }, headers={"X-Forwarded-For": f"10.{subnet}.{i // 256}.{i % 256}"})
+
+        try:
+            with ThreadPoolExecutor(max_workers=burst) as executor:
+                responses = list(executor.map(signup, range(burst)))
+
+            statuses = [response.status_code for response in responses]
+            shed = [response for response in responses if response.status_code == 503]
+            unexpected = sorted(set(statuses) - {200, 503})
+            if unexpected:
+                self.log_test(name, False, f"Unexpected statuses {unexpected} in a burst of {burst}")
+                return False
+            if not shed:
+                self.log_test(name, False, f"None of {burst} concurrent signups was shed")
+                return False
+            if not all(response.headers.get("Retry-After", "").isdigit() for response in shed):
+                self.log_test(name, False, "A 503 came without Retry-After", dict(shed[0].headers))
+                return False
+            self.log_test(name, True, f"{len(shed)} of {burst} concurrent signups shed with 503 and Retry-After, "
+                                      f"{statuses.count(200)} served")
+            return True
+        except Exception as e:
+            self.log_test(name, False, f"Error: {str(e)}")
+            return False
+
     def run_all_tests(self):
         """Run all tests in sequence"""
         print(f"\n🚀 Starting ShopLuxe Backend API Tests")
@@ -487,28 +1478,52 @@ class ShopLuxeAPITester:
         self.test_get_categories()
         self.test_get_products_by_category()
         self.test_get_individual_product()
+        self.test_products_batch()
+        self.test_product_listing_queries()
+        self.test_search()
+        self.test_search_index_update()
+        self.test_catalog_etag_revalidation()
+        self.test_compression_negotiation()
+        self.test_image_derivatives()
+        self.test_promotion_schedule()
         
         # Authentication Tests
         print("\n🔐 AUTHENTICATION FLOW")
         self.test_user_signup()
         self.test_duplicate_signup()
+        self.test_concurrent_duplicate_signup()
         self.test_email_verification()
         self.test_user_login()
+        self.test_me_and_logout()
         
         # E-commerce Tests
         print("\n🛒 E-COMMERCE FEATURES")
         self.test_create_order_paypal()
         self.test_create_order_card()
+        self.test_order_idempotency()
+        self.test_order_history()
         
         # Affiliate Tests
         print("\n💰 AFFILIATE SYSTEM")
         self.test_affiliate_signup()
         self.test_affiliate_dashboard()
+        self.test_affiliate_code_allocation()
+        self.test_affiliate_clicks()
         self.test_order_with_affiliate()
+        self.test_attribution_rebuild()
+        self.test_affiliate_withdrawals()
+        self.test_withdrawal_migration()
+        
+        # Operations Tests
+        print("\n📈 OPERATIONS")
+        self.test_metrics()
+        self.test_readiness()
         
         # Error Handling Tests
         print("\n⚠️  ERROR HANDLING")
         self.test_invalid_endpoints()
+        self.test_auth_rate_limit()
+        self.test_auth_load_shedding()
         
         # Summary
         print("\n" + "=" * 80)
@@ -15,6 +15,9 @@ const AuthProvider = ({ children }) => {
   useEffect(() => {
     if (sessionToken) {
       setUser({ sessionToken });
+      axios.defaults.headers.common['Authorization'] = `Bearer ${sessionToken}`;
+    } else {
+      delete axios.defaults.headers.common['Authorization'];
     }
   }, [sessionToken]);
 
@@ -58,6 +61,16 @@ const generateDeviceFingerprint = () => {
   return btoa(fingerprint).substring(0, 32);
 };
 
+// Idempotency keys for checkout. crypto.randomUUID only exists in secure
+// contexts (HTTPS or localhost); getRandomValues works on plain HTTP too.
+const generateIdempotencyKey = () => {
+  if (window.crypto.randomUUID) {
+    return window.crypto.randomUUID();
+  }
+  const bytes = window.crypto.getRandomValues(new Uint8Array(16));
+  return Array.from(bytes, (byte) => byte.toString(16).padStart(2, '0')).join('');
+};
+
 // Components
 const LandingPage = () => {
   const { user } = useAuth();
@@ -192,7 +205,12 @@ const ProductCard = ({ product }) => {
   return (
     <div className="bg-white rounded-xl shadow-lg overflow-hidden hover:shadow-xl transition-shadow">
       <img
-        src={product.image}
+        src={product.thumbnail ? `${BACKEND_URL}${product.thumbnail}` : product.image}
+        srcSet={product.image_srcset
+          ? product.image_srcset.split(', ').map((candidate) => `${BACKEND_URL}${candidate}`).join(', ')
+          : undefined}
+        sizes="(min-width: 1024px) 33vw, (min-width: 768px) 50vw, 100vw"
+        loading="lazy"
         alt={product.name}
         className="w-full h-48 object-cover"
       />
@@ -250,6 +268,8 @@ const CheckoutModal = ({ product, onClose }) => {
   });
   const [loading, setLoading] = useState(false);
   const [message, setMessage] = useState('');
+  // One key per checkout so retried submissions never create a second order
+  const [idempotencyKey] = useState(generateIdempotencyKey);
 
   const handleSubmit = async (e) => {
     e.preventDefault();
@@ -262,7 +282,9 @@ const CheckoutModal = ({ product, onClose }) => {
         card_info: paymentMethod === 'card' ? cardInfo : null
       };
 
-      const response = await axios.post(`${API}/order`, orderData);
+      const response = await axios.post(`${API}/order`, orderData, {
+        headers: { 'Idempotency-Key': idempotencyKey }
+      });
       
       if (response.data.success) {
         setMessage('Order placed successfully! You will receive confirmation shortly.');